@@ -0,0 +1,58 @@
+# backend.py
+#
+# Copyright (c) 2017 Oak Ridge National Laboratory.
+# All rights reserved.
+# See file LICENSE that is included with this distribution.
+#
+# @author Klemen Vodopivec
+
+"""
+PV backends provide channels to websocket.PV objects.
+
+Backend is a channel factory, a function taking PV url like ca://NAME and
+returning new channel object. Channels follow pvaccess.Channel interface so
+that pvaccess channels are used as they are:
+
+    subscribe(name, callback) - register monitor callback, callback is
+                                invoked from any thread with an object
+                                providing toDict()
+    unsubscribe(name)         - remove monitor callback
+    startMonitor(request)     - start monitor with pvRequest string like
+                                "field()" or "field(value,alarm)"
+    stopMonitor()             - stop monitor
+    get()                     - return current value as object providing
+                                toDict(), blocking
+    put(value)                - write new value, blocking
+    setTimeout(timeout)       - limit time of blocking calls
+
+Backend is selected in 'backend' configuration section.
+"""
+
+try:
+    import pvaccess
+except ImportError:
+    pvaccess = None
+
+from common import WebEpicsError
+import simulator
+
+def createPvaccessChannel(pvurl):
+    """ Channel factory creating pvaccess channels connected to IOCs. """
+    if pvaccess is None:
+        raise WebEpicsError("pvaccess module not available")
+
+    protocol, pvname = pvurl.split("://", 1)
+    if protocol == "pva":
+        return pvaccess.Channel(pvname, pvaccess.PVA)
+    return pvaccess.Channel(pvname, pvaccess.CA)
+
+def createChannelFactory(cfg):
+    """ Return channel factory selected by configuration. """
+    backend = cfg.get("type", "pvaccess")
+    if backend == "pvaccess":
+        if pvaccess is None:
+            raise WebEpicsError("Configuration error: pvaccess backend selected but pvaccess module not available")
+        return createPvaccessChannel
+    elif backend == "simulator":
+        return simulator.Simulator(cfg.get("simulator", {})).createChannel
+    raise WebEpicsError("Configuration error: unsupported backend '{0}'".format(backend))
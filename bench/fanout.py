@@ -0,0 +1,129 @@
+# fanout.py
+#
+# Copyright (c) 2017 Oak Ridge National Laboratory.
+# All rights reserved.
+# See file LICENSE that is included with this distribution.
+#
+# @author Klemen Vodopivec
+#
+
+"""
+Benchmark of PV update fan-out to WebSocket clients.
+
+Compares CPU time spent per single PV update when every client encodes its
+own pv_update frame against encoding the frame once and sending the same
+frame to all subscribed clients. No EPICS channels or network connections
+are involved, clients are WebSocketHandler objects with write_message()
+replaced by a function that only counts bytes. Both ways must send the
+same number of bytes, unless shared way sends binary frames.
+
+Usage: python bench/fanout.py [--updates N] [--clients 1,10,100,1000] [--waveform N] [--binary]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import tornado.escape
+import tornado.ioloop
+
+import websocket
+
+PVURL = "ca://BENCH:Value"
+
+class BenchClient(websocket.WebSocketHandler):
+    """ WebSocketHandler that is not connected anywhere, only counts sent bytes. """
+
+    def __init__(self, pv):
+        # Skip tornado.web.RequestHandler initialization, no request here
+        self._pvs = {}
+        self._ioloop = tornado.ioloop.IOLoop.current()
+        self._ctx = { "binary_min_size": 64, "max_buffer": 4194304 }
+        self._multiplex = False
+        self._binary = False
+        self._outbox = []
+        self._outboxBytes = 0
+        self._degraded = None
+        self._pvs[PVURL] = {
+            "pv": pv,
+            "rate_limit": 0,
+            "fields": None,
+            "pending": None,
+            "last_sent": 0,
+            "flush": None
+        }
+        self.sent = 0
+
+    def getWriteBufferSize(self):
+        return 0
+
+    def write_message(self, message, binary=False):
+        if isinstance(message, dict):
+            message = tornado.escape.json_encode(message)
+        self.sent += len(message)
+
+def createUpdate(waveform):
+    """ Return typical NTScalar or NTScalarArray update. """
+    d = {
+        "value": 12.3456,
+        "alarm": { "severity": 0, "status": 0, "message": "NO_ALARM" },
+        "timeStamp": { "secondsPastEpoch": 1500000000, "nanoseconds": 123456789, "userTag": 0 },
+        "display": { "limitLow": 0.0, "limitHigh": 100.0, "description": "Benchmark PV", "format": "%.3f", "units": "mA" }
+    }
+    if waveform:
+        d["value"] = [ i * 0.5 for i in range(waveform) ]
+    return d
+
+def perClient(pv, clients, update):
+    """ Old behaviour, each client copies update and encodes it. """
+    for client in clients:
+        rsp = dict(update)
+        rsp["pv"] = PVURL
+        rsp["rsp"] = "pv_update"
+        client.write_message(rsp)
+
+def shared(pv, clients, update):
+    """ New behaviour, encode once and fan-out the same frame. """
+    pv.sendToClients(update, clients)
+
+def measure(func, pv, clients, update, count):
+    """ Return CPU time per update in microseconds and number of bytes sent. """
+    for client in clients:
+        client.sent = 0
+    start = time.clock()
+    for i in range(count):
+        update["timeStamp"]["nanoseconds"] = i
+        func(pv, clients, update)
+    elapsed = (time.clock() - start) * 1e6 / count
+    return (elapsed, sum(client.sent for client in clients))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebEPICS PV update fan-out benchmark")
+    parser.add_argument("--updates", type=int, default=1000, help="Number of PV updates per measurement")
+    parser.add_argument("--clients", default="1,10,100,1000", help="Comma separated number of subscribers")
+    parser.add_argument("--waveform", type=int, default=0, help="Send waveform of given size instead of scalar value")
+    parser.add_argument("--binary", action="store_true", help="Shared path sends arrays as binary frames")
+    args = parser.parse_args()
+
+    pv = websocket.PV(PVURL)
+    update = createUpdate(args.waveform)
+
+    print "{0:>8} {1:>18} {2:>18} {3:>8}".format("clients", "per-client [us]", "shared [us]", "speedup")
+    for n in [ int(x) for x in args.clients.split(",") ]:
+        clients = [ BenchClient(pv) for i in range(n) ]
+        for client in clients:
+            client._binary = args.binary
+            # Subscribe without opening a channel, PV only sends to subscribed clients
+            pv._clients[client] = None
+        count = max(10, args.updates / n)
+        t_old, sent_old = measure(perClient, pv, clients, update, count)
+        t_new, sent_new = measure(shared, pv, clients, update, count)
+        for client in clients:
+            del pv._clients[client]
+        if sent_new == 0 or (not args.binary and sent_new != sent_old):
+            print "Error: per-client sent {0} bytes, shared sent {1} bytes".format(sent_old, sent_new)
+            sys.exit(1)
+        print "{0:>8} {1:>18.1f} {2:>18.1f} {3:>7.1f}x".format(n, t_old, t_new, t_old / t_new if t_new > 0 else 0)
@@ -0,0 +1,417 @@
+# loadtest.py
+#
+# Copyright (c) 2017 Oak Ridge National Laboratory.
+# All rights reserved.
+# See file LICENSE that is included with this distribution.
+#
+# @author Klemen Vodopivec
+#
+
+"""
+Load test of WebEPICS server with many simulated browser clients.
+
+Starts web server with simulator backend, opens N WebSocket connections
+and subscribes each one to M PVs randomly picked from a shared pool, using
+the same requests as processOnConnect() in webepics-opi.js. Clients are
+spread over several processes so that the test itself doesn't become the
+bottleneck.
+
+Simulator time stamps every update when it is generated, the difference to
+the time client receives it is reported as end-to-end latency. Server CPU
+usage and memory include all server processes (workers and gateway).
+Only the period after ramp-up and warm-up is measured.
+
+Usage: python bench/loadtest.py [--clients N] [--pvs M] [--pool P] [--mix scalar:70,enum:10,waveform:20] ...
+       python bench/loadtest.py --help
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+import tornado.gen
+import tornado.ioloop
+import tornado.websocket
+
+# Latency histogram resolution, buckets per decade
+BUCKETS_PER_DECADE = 50
+
+PV_TYPES = {
+    "scalar": "ca://LOADTEST:Scalar{0}",
+    "enum": "ca://LOADTEST:Enum{0}",
+    "waveform": "ca://LOADTEST:Wf{0}"
+}
+
+##############################################################################
+### Server                                                                 ###
+##############################################################################
+
+def createConfig(args, tmpdir):
+    """ Write server configuration using simulator backend, return its path. """
+    for subdir in ("orig", "cache"):
+        os.mkdir(os.path.join(tmpdir, subdir))
+    cfg = {
+        "server": { "port": args.port, "threads": args.threads },
+        "static_web": { "path": os.path.join(ROOT, "static") },
+        "convert": {
+            "files": { "path": os.path.join(tmpdir, "orig") },
+            "cache": { "path": os.path.join(tmpdir, "cache") },
+            "opi": { "templates": os.path.join(ROOT, "templates", "opi") },
+            "bob": { "templates": os.path.join(ROOT, "templates", "bob") }
+        },
+        "backend": {
+            "type": "simulator",
+            "simulator": {
+                "type": "scalar",
+                "rate": args.rate,
+                "pvs": [
+                    { "match": "LOADTEST:Enum", "type": "enum" },
+                    { "match": "LOADTEST:Wf", "type": "waveform", "size": args.waveform_size }
+                ]
+            }
+        },
+        "gateway": {
+            "enabled": args.gateway,
+            "socket": os.path.join(tmpdir, "gateway.sock")
+        }
+    }
+    path = os.path.join(tmpdir, "webepics.conf")
+    with open(path, "w") as f:
+        # JSON is valid YAML
+        json.dump(cfg, f, indent=4)
+    return path
+
+def startServer(args, tmpdir):
+    """ Start web server in its own process group and wait until it accepts connections. """
+    conf = createConfig(args, tmpdir)
+    log = open(os.path.join(tmpdir, "server.log"), "w")
+    server = subprocess.Popen([ sys.executable, os.path.join(ROOT, "server.py"), "-c", conf ],
+                              cwd=ROOT, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+    deadline = time.time() + 10.0
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Server exited, see {0}".format(log.name))
+        try:
+            socket.create_connection(("localhost", args.port), 0.5).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    stopServer(server)
+    raise RuntimeError("Server didn't start in time, see {0}".format(log.name))
+
+def stopServer(server):
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    server.wait()
+
+def getProcessTree(pid):
+    """ Return list of pid and all its descendants. """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(entry)) as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [ pid ]
+    i = 0
+    while i < len(pids):
+        pids += children.get(pids[i], [])
+        i += 1
+    return pids
+
+def getCpuSeconds(pids):
+    """ Return user and system CPU time consumed by processes. """
+    total = 0
+    for pid in pids:
+        try:
+            with open("/proc/{0}/stat".format(pid)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except (IOError, IndexError, ValueError):
+            pass
+    return float(total) / os.sysconf("SC_CLK_TCK")
+
+def getRssBytes(pids):
+    """ Return resident memory of processes. """
+    total = 0
+    for pid in pids:
+        try:
+            with open("/proc/{0}/status".format(pid)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except (IOError, ValueError):
+            pass
+    return total
+
+##############################################################################
+### Clients                                                                ###
+##############################################################################
+
+def createPvPool(args):
+    """ Return list of PV urls with types distributed according to mix. """
+    mix = {}
+    for entry in args.mix.split(","):
+        pvtype, share = entry.split(":")
+        if pvtype not in PV_TYPES:
+            raise ValueError("Unknown PV type '{0}'".format(pvtype))
+        mix[pvtype] = float(share)
+    total = sum(mix.values())
+
+    pool = []
+    for pvtype in sorted(mix):
+        count = int(round(args.pool * mix[pvtype] / total))
+        pool += [ PV_TYPES[pvtype].format(i) for i in range(count) ]
+    return pool
+
+def createRequests(pvurls, fields, rate_limit):
+    """ Return subscribe requests just like processOnConnect() in webepics-opi.js. """
+    req = { "pvs": list(pvurls), "req": "pv_subscribe" }
+    if rate_limit > 0:
+        req["rate_limit"] = rate_limit
+    if fields:
+        req["fields"] = sorted(fields)
+    return [ req ]
+
+def decodeFrame(frame):
+    """ Return response message, numeric arrays of binary frames are not decoded. """
+    if isinstance(frame, unicode):
+        return json.loads(frame)
+    length, = struct.unpack_from("<I", frame, 0)
+    return json.loads(frame[4:4 + length])
+
+class ClientStats():
+    """ Statistics of all clients in one process, can be merged. """
+
+    def __init__(self):
+        self.connected = 0
+        self.errors = 0
+        self.dropped = 0
+        self.frames = 0
+        self.bytes = 0
+        self.updates = 0
+        self.latency = {}
+
+    def addLatency(self, seconds):
+        bucket = int(math.floor(math.log10(max(seconds, 1e-6)) * BUCKETS_PER_DECADE))
+        self.latency[bucket] = self.latency.get(bucket, 0) + 1
+
+    def merge(self, other):
+        for key in ("connected", "errors", "dropped", "frames", "bytes", "updates"):
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+        for bucket, count in other.latency.iteritems():
+            self.latency[bucket] = self.latency.get(bucket, 0) + count
+
+    def getPercentile(self, percent):
+        """ Return latency in seconds, upper bound of bucket with percentile. """
+        target = sum(self.latency.values()) * percent / 100.0
+        total = 0
+        for bucket in sorted(self.latency):
+            total += self.latency[bucket]
+            if total >= target and total > 0:
+                return 10 ** (float(bucket + 1) / BUCKETS_PER_DECADE)
+        return 0.0
+
+@tornado.gen.coroutine
+def runClient(url, pvurls, args, stats, startAt, measureStart, deadline):
+    """ Single browser-like client, receives updates until deadline. """
+    yield tornado.gen.sleep(max(0, startAt - time.time()))
+    try:
+        conn = yield tornado.websocket.websocket_connect(url, max_message_size=1 << 30)
+    except Exception:
+        stats.errors += 1
+        return
+    stats.connected += 1
+
+    fields = args.fields.split(",") if args.fields else None
+    for req in createRequests(pvurls, fields, args.rate_limit):
+        conn.write_message(json.dumps(req))
+    timer = tornado.ioloop.IOLoop.current().call_later(max(0, deadline - time.time()), conn.close)
+
+    # Time stamps only include fields that changed, keep the last full one
+    timestamps = {}
+    while True:
+        frame = yield conn.read_message()
+        now = time.time()
+        if frame is None:
+            break
+
+        try:
+            message = decodeFrame(frame)
+        except Exception:
+            stats.errors += 1
+            continue
+        if message.get("rsp") == "pv_updates":
+            updates = message["updates"]
+        elif message.get("rsp") == "pv_update":
+            updates = [ message ]
+        else:
+            continue
+
+        measure = (now >= measureStart and now < deadline)
+        if measure:
+            stats.frames += 1
+            stats.bytes += len(frame)
+            stats.updates += len(updates)
+        for update in updates:
+            if "timeStamp" not in update:
+                continue
+            ts = timestamps.setdefault(update["pv"], {})
+            ts.update(update["timeStamp"])
+            if measure and "secondsPastEpoch" in ts:
+                stats.addLatency(now - ts["secondsPastEpoch"] - ts.get("nanoseconds", 0) * 1e-9)
+
+    if time.time() < deadline - 0.5:
+        stats.dropped += 1
+    tornado.ioloop.IOLoop.current().remove_timeout(timer)
+
+def clientProcess(url, clients, args, startTime, measureStart, deadline, queue):
+    """ Run subset of clients in this process and report statistics through queue. """
+    stats = ClientStats()
+    ramp = float(args.ramp) / max(1, args.clients)
+
+    @tornado.gen.coroutine
+    def main():
+        yield [ runClient(url, pvurls, args, stats, startTime + i * ramp, measureStart, deadline)
+                for i, pvurls in clients ]
+
+    tornado.ioloop.IOLoop.current().run_sync(main)
+    queue.put(stats)
+
+##############################################################################
+### Main                                                                   ###
+##############################################################################
+
+def report(args, stats, cpu, rss, elapsed):
+    """ Print results in human readable form or as JSON. """
+    result = {
+        "clients": args.clients,
+        "connected": stats.connected,
+        "errors": stats.errors,
+        "disconnected": stats.dropped,
+        "pvs_per_client": args.pvs,
+        "duration_s": elapsed,
+        "frames_per_s": stats.frames / elapsed,
+        "updates_per_s": stats.updates / elapsed,
+        "bytes_per_s": stats.bytes / elapsed,
+        "latency_ms": dict(("p{0:g}".format(p), stats.getPercentile(p) * 1e3) for p in (50, 90, 99, 99.9)),
+        "server_cpu_percent": cpu,
+        "server_rss_bytes": rss
+    }
+    if args.json:
+        print json.dumps(result, indent=4, sort_keys=True)
+        return
+
+    print "{0:<24} {1} ({2} connected, {3} errors, {4} disconnected early)".format(
+        "clients", args.clients, stats.connected, stats.errors, stats.dropped)
+    print "{0:<24} {1}".format("PVs per client", args.pvs)
+    print "{0:<24} {1:.1f} s".format("measured", elapsed)
+    print "{0:<24} {1:.0f}".format("frames/s", result["frames_per_s"])
+    print "{0:<24} {1:.0f}".format("updates/s", result["updates_per_s"])
+    print "{0:<24} {1:.2f} MB/s".format("received", result["bytes_per_s"] / 1e6)
+    print "{0:<24} p50 {1:.2f}  p90 {2:.2f}  p99 {3:.2f}  p99.9 {4:.2f}".format("latency [ms]",
+        result["latency_ms"]["p50"], result["latency_ms"]["p90"], result["latency_ms"]["p99"], result["latency_ms"]["p99.9"])
+    if cpu is not None:
+        print "{0:<24} {1:.1f} %".format("server CPU", cpu)
+        print "{0:<24} {1:.1f} MB".format("server RSS", rss / 1e6)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebEPICS load test with simulated clients and PVs")
+    parser.add_argument("--clients", type=int, default=100, help="Number of WebSocket clients")
+    parser.add_argument("--pvs", type=int, default=20, help="Number of PVs each client subscribes to")
+    parser.add_argument("--pool", type=int, default=200, help="Number of distinct PVs clients pick from")
+    parser.add_argument("--mix", default="scalar:70,enum:10,waveform:20", help="Share of PV types in pool")
+    parser.add_argument("--rate", type=float, default=10.0, help="Updates per second of each PV")
+    parser.add_argument("--waveform-size", type=int, default=1000, help="Number of waveform elements")
+    parser.add_argument("--fields", default="alarm,timeStamp,value", help="Comma separated fields to subscribe to, empty for all")
+    parser.add_argument("--rate-limit", type=float, default=0, help="Client requested rate limit")
+    parser.add_argument("--no-multiplex", action="store_true", help="Don't request multiplexed updates")
+    parser.add_argument("--no-binary", action="store_true", help="Don't request binary arrays")
+    parser.add_argument("--threads", type=int, default=1, help="Number of server processes")
+    parser.add_argument("--gateway", action="store_true", help="Enable PV gateway process")
+    parser.add_argument("--duration", type=float, default=30.0, help="Measured time in seconds")
+    parser.add_argument("--ramp", type=float, default=5.0, help="Seconds to open all connections")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Seconds after ramp-up not measured")
+    parser.add_argument("--client-procs", type=int, default=min(4, multiprocessing.cpu_count()), help="Number of client processes")
+    parser.add_argument("--port", type=int, default=18888, help="Port of started server")
+    parser.add_argument("--url", help="Test already running server at this WebSocket URL instead")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for picking PVs")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    pool = createPvPool(args)
+    rnd = random.Random(args.seed)
+    clients = [ (i, rnd.sample(pool, min(args.pvs, len(pool)))) for i in range(args.clients) ]
+
+    tmpdir = None
+    server = None
+    url = args.url
+    if url is None:
+        tmpdir = tempfile.mkdtemp(prefix="webepics-loadtest-")
+        server = startServer(args, tmpdir)
+        url = "ws://localhost:{0}/ws".format(args.port)
+    params = []
+    if not args.no_multiplex:
+        params.append("multiplex=1")
+    if not args.no_binary:
+        params.append("binary=1")
+    if params:
+        url += ("&" if "?" in url else "?") + "&".join(params)
+
+    try:
+        startTime = time.time() + 0.5
+        measureStart = startTime + args.ramp + args.warmup
+        deadline = measureStart + args.duration
+
+        queue = multiprocessing.Queue()
+        procs = []
+        for n in range(max(1, args.client_procs)):
+            proc = multiprocessing.Process(target=clientProcess,
+                                           args=(url, clients[n::args.client_procs], args, startTime, measureStart, deadline, queue))
+            proc.start()
+            procs.append(proc)
+
+        cpu = rss = None
+        time.sleep(max(0, measureStart - time.time()))
+        if server is not None:
+            pids = getProcessTree(server.pid)
+            cpuStart = getCpuSeconds(pids)
+        time.sleep(max(0, deadline - time.time()))
+        if server is not None:
+            pids = getProcessTree(server.pid)
+            cpu = (getCpuSeconds(pids) - cpuStart) * 100.0 / args.duration
+            rss = getRssBytes(pids)
+
+        stats = ClientStats()
+        for proc in procs:
+            stats.merge(queue.get())
+        for proc in procs:
+            proc.join()
+
+        report(args, stats, cpu, rss, args.duration)
+    finally:
+        if server is not None:
+            stopServer(server)
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
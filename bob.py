@@ -27,7 +27,8 @@ FORMAT_TYPES=["%{0}b", "%{0}d", "%{0}f", "%{0}x", "%{0}b", "%{0}x", "%{0}b", "%{
 class Converter:
     """ BOB convert helper class.
 
-    Implements getHtml() and replaceMacros() methods. Called from outside.
+    Implements getHtml(), parse(), render(), replaceMacros() and
+    compileMacros() methods. Called from outside.
     """
 
     def __init__(self, templates_dir, caching):
@@ -38,7 +39,15 @@ class Converter:
     def replaceMacros(self, str, macros):
         return Macros.replace(str, macros)
 
+    def compileMacros(self, html):
+        """ Return MacroTemplate for replacing run-time macros in rendered HTML. """
+        return opi.MacroTemplate(html)
+
     def getHtml(self, xml_str, macros={}):
+        return self.render(self.parse(xml_str), macros)
+
+    def parse(self, xml_str):
+        """ Parse XML string and return top-level Display widget. """
         try:
             node = xml.dom.minidom.parseString(xml_str)
         except Exception, e:
@@ -50,7 +59,10 @@ class Converter:
         # Start with top-level Display widget
         display = Display()
         display.parse(node.documentElement)
+        return display
 
+    def render(self, display, macros={}):
+        """ Return HTML of parsed Display widget. """
         return self._renderWidget(display, macros)
 
     def _renderWidget(self, widget, macros, unique_id=1):
@@ -547,6 +559,7 @@ class TextUpdate(Widget):
     def parse(self, node):
         done = super(TextUpdate, self).parse(node)
 
+        deadband = None
         if self.precision == -1:
             fmt = "%s"
         else:
@@ -555,7 +568,9 @@ class TextUpdate(Widget):
             if self.format_type.index == 5:
                 precision = 8
 
+            deadband = opi.getDeadband(fmt, precision)
             fmt = fmt.format(precision)
         self.setField("value_format", fmt)
+        self.setField("deadband", deadband)
 
         return done
@@ -17,3 +17,12 @@ class WebEpicsWarning(RuntimeWarning):
     def __init__(self, message, error=None):
         super(WebEpicsWarning, self).__init__(message)
         self.error = error
+
+class PvValue():
+    """ PV structure from other backends than pvaccess, provides toDict() like pvaccess.PvObject. """
+
+    def __init__(self, d):
+        self._d = d
+
+    def toDict(self):
+        return self._d
@@ -23,13 +23,52 @@ default_cfg = {
         "threads": 1,
         "redirects": {}
     },
+    "websocket": {
+        "queue_size": 16,
+        "multiplex": False,
+        "binary": False,
+        "binary_min_size": 64,
+        "max_buffer": 4194304,
+        "stall_timeout": 30.0,
+        "put_threads": 4,
+        "put_timeout": 5.0,
+        "get_threads": 4,
+        "get_timeout": 5.0,
+        "get_cache_ttl": 1.0,
+        "get_cache_size": 1000,
+        "linger": 10.0,
+        "linger_pool_size": 1000,
+        "session_grace": 30.0,
+        "session_pool_size": 10000,
+        "session_history": 32,
+        "deadband_hold": 1.0
+    },
+    "backend": {
+        "type": "pvaccess",
+        "simulator": {
+            "type": "scalar",
+            "rate": 1.0,
+            "size": 1000,
+            "pvs": []
+        }
+    },
+    "gateway": {
+        "enabled": False,
+        "spawn": True,
+        "socket": "/tmp/webepics-gateway.sock",
+        "max_buffer": 4194304
+    },
     "static_web": {
         "path": "static/"
     },
     "convert": {
         "use_cache": True,
-        "files": { "path": "orig/" },
+        # Connections to remote (http/https) path are kept alive only with pycurl installed
+        "files": { "path": "orig/", "timeout": 2.0, "max_requests": 10, "watch": False, "watch_delay": 0.5 },
         "cache": { "path": "cache/" },
+        "memory_cache": { "size": 67108864 },
+        "workers": 2,
+        "worker_timeout": 60.0,
         "opi": { "templates": "templates/opi/" },
         "bob": { "templates": "templates/bob/" }
     }
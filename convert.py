@@ -6,26 +6,59 @@
 #
 # @author Klemen Vodopivec
 #
+import calendar
+import collections
 import common
+import concurrent.futures
+import datetime
+import email.utils
 import logging
 import md5
 import mimetypes
 import os
 import re
+import signal
 import time
 import sys
-import urllib2
 import urlparse
 
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
 from common import WebEpicsError, WebEpicsWarning
 import opi
 import bob
+import timing
+import watcher
 
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
 import tornado.web
 import tornado.escape
 
 log = logging.getLogger(__name__)
 
+# Statistics of all ConvertHandler requests, requests and errors only count
+# files with converter
+convertStats = {
+    "requests": 0,
+    "static": 0,
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "conversions": 0,
+    "errors": 0
+}
+
+# Timing of file conversion stages
+mtimeTiming = timing.getHistogram("convert_mtime", "Checking modification time of original file")
+cacheReadTiming = timing.getHistogram("convert_cache_read", "Reading converted file from cache")
+parseTiming = timing.getHistogram("convert_parse", "Parsing original file")
+renderTiming = timing.getHistogram("convert_render", "Rendering HTML from parsed file")
+macrosTiming = timing.getHistogram("convert_macros", "Replacing run-time macros")
+
 class FileCache:
     """ Local file storage abstraction class.
 
@@ -114,26 +147,123 @@ class FileCache:
         log.debug("Read from cache {0} -> {1}".format(path, filename))
         return data
 
+class MemoryCache:
+    """ LRU cache of converted files kept in memory, in front of FileCache.
+
+    Entries are keyed by requested file name and remember modification time
+    of the original file they were converted from. Total size of cached data
+    is limited to max_bytes, least recently used entries are evicted first.
+    When files are watched for changes, changed files are invalidated and
+    modification time doesn't need to be checked.
+    """
+
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._version = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filename, mtime=None):
+        """ Return cached data or None when not cached or original file is newer.
+
+        mtime is modification time of original file, None to skip the check.
+        """
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            if mtime is None or entry[1] >= mtime:
+                # Move to the end as most recently used
+                self._entries[filename] = entry
+                self.stats["hits"] += 1
+                return entry[0]
+            self.bytes -= entry[2]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, filename, data, mtime, size=None, version=None):
+        """ Cache data converted from original file modified at mtime.
+
+        size is the number of bytes data takes, length of data by default.
+        version is the value of getVersion() before original file was
+        loaded, data is not cached when any file was invalidated since.
+        """
+        if size is None:
+            size = len(data)
+        self.discard(filename)
+        if size > self.max_bytes or (version is not None and version != self._version):
+            return
+
+        self._entries[filename] = (data, mtime, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, _, oldest) = self._entries.popitem(last=False)
+            self.bytes -= oldest
+            self.stats["evictions"] += 1
+
+    def discard(self, filename):
+        """ Remove file from cache, return True if it was cached. """
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+            return True
+        return False
+
+    def getVersion(self):
+        """ Return number that changes every time a file is invalidated. """
+        return self._version
+
+    def invalidate(self, filename):
+        """ Remove changed file from cache, None for all files. Return True if it was cached. """
+        self._version += 1
+        self.stats["invalidations"] += 1
+        if filename is None:
+            self._entries.clear()
+            self.bytes = 0
+            return False
+        return self.discard(filename)
+
+# In-memory tier of converted files, configured by ConvertHandler.createContext()
+memoryCache = MemoryCache()
+
 
 class FileLoader:
     """ Helper class for loading file contents from file system or URL.
     
-    Class abstracts the way to work with local or remote files. 
+    Class abstracts the way to work with local or remote files. All functions
+    accessing files are coroutines. Local files are read right away, remote
+    files are fetched with Tornado's AsyncHTTPClient without blocking IOLoop.
     """
 
-    def __init__(self, path, timeout=2.0):
+    def __init__(self, path, timeout=2.0, max_requests=10):
         """ Initialize FileLoader class with user parameters.
 
         path can be an URL or a relative/absolute file system path. Only http
         and https URLs are supported. Function will raise RuntimeError exception
         when path parameter can not be parsed.
-        Timeout is only applicable to URL paths. """
+        Timeout is only applicable to URL paths, as is max_requests which
+        limits number of concurrent requests to remote web server, others
+        wait in queue. When pycurl is available, connections to web server
+        are kept open and reused. """
         self.timeout = timeout
 
         r = urlparse.urlparse(path)
         if r.scheme == "http" or r.scheme == "https":
             self.url = path + "/"
             self.dir = None
+
+            # Client instances are created per IOLoop, configuration applies to all
+            impl = "tornado.curl_httpclient.CurlAsyncHTTPClient" if pycurl is not None else None
+            tornado.httpclient.AsyncHTTPClient.configure(impl, max_clients=max_requests)
+            if pycurl is None:
+                log.warn("pycurl module not available, new connection will be opened for every request to {0}".format(path))
         elif r.scheme == "file" or r.scheme == "":
             path = r.path
             if not os.path.isabs(path):
@@ -147,15 +277,16 @@ class FileLoader:
         else:
             raise WebEpicsError("Failed to initialize FileLoader, unsupported path: {0}".format(path))
 
+    @tornado.gen.coroutine
     def get(self, filename, timeout=None):
         """ Return file contents.
 
         Loads a filename relative to the path location passed to constructor
-        and return its contents. Raises RuntimeError when file can not be
+        and return its contents. Raises WebEpicsWarning when file can not be
         loaded.
 
-        This is a blocking call that may take long time depending on the
-        availability of the URL. Use timeout parameter to limit time to load.
+        Loading from URL may take long time depending on the availability
+        of the URL. Use timeout parameter to limit time to load.
         """
 
         if timeout is None:
@@ -175,18 +306,19 @@ class FileLoader:
                 else:
                     raise WebEpicsWarning("Failed to open file: {0}".format(filename))
 
-        else:
-            url = urlparse.urljoin(self.url, filename)
             try:
-                f = urllib2.urlopen(url, timeout=timeout)
-            except URLError:
-                raise WebEpicsWarning("Failed to fetch file: {0}".format(url))
+                data = f.read()
+                f.close()
+            except Exception as e:
+                raise WebEpicsWarning("Failed to read file: {0}".format(e))
 
-        try:
-            return f.read()
-        except Exception as e:
-            raise WebEpicsWarning("Failed to read file: {0}".format(e))
+        else:
+            response = yield self._fetch(filename, "GET", timeout)
+            data = response.body
+
+        raise tornado.gen.Return(data)
 
+    @tornado.gen.coroutine
     def getModifiedTime(self, filename, timeout=None):
         """ Return time when file was last modified as unix EPOCH. """
 
@@ -198,7 +330,7 @@ class FileLoader:
             if not path.startswith(self.dir):
                 raise WebEpicsWarning("Requested path outside base directory: {0}".format(path), 404)
             try:
-                return int(os.path.getmtime(path))
+                mtime = int(os.path.getmtime(path))
             except OSError, e:
                 if e.errno == 2:
                     raise WebEpicsWarning("File not found: {0}".format(filename), 404)
@@ -208,18 +340,21 @@ class FileLoader:
                     raise WebEpicsWarning("Failed to open file: {0}".format(filename))
 
         else:
-            # TODO: need to re-design and use Tornado async mechanism
-            url = urlparse.urljoin(self.url, filename)
-            request = urllib2.Request(url)
-            request.get_method = lambda: "HEAD"
-            response = urllib2.urlopen(request, timeout=timeout)
-            header = response.info().getheader("Last-Modified")
-            return int(time.mktime(time.strptime(header, '%a, %d %b %Y %H:%M:%S GMT')))
+            response = yield self._fetch(filename, "HEAD", timeout)
+            header = email.utils.parsedate(response.headers.get("Last-Modified", ""))
+            if header is None:
+                # Can't tell, assume it was just modified
+                mtime = int(time.time())
+            else:
+                mtime = calendar.timegm(header)
+
+        raise tornado.gen.Return(mtime)
 
     def isRemote(self):
         """ Return True if configured to load files from remote web server. """
         return not self.dir
 
+    @tornado.gen.coroutine
     def getContentType(self, filename):
         """ Return Content-Type header to be used for this file. """
         
@@ -231,17 +366,189 @@ class FileLoader:
             mime_type, encoding = mimetypes.guess_type(path)
 
             if encoding == "gzip":
-                return "application/gzip"
+                content_type = "application/gzip"
             elif encoding is None and mime_type is not None:
-                return mime_type
+                content_type = mime_type
             else:
-                return "application/octet-stream"
+                content_type = "application/octet-stream"
         else:
-            url = urlparse.urljoin(self.url, filename)
-            request = urllib2.Request(url)
-            request.get_method = lambda: "HEAD"
-            response = urllib2.urlopen(request, timeout=self.timeout)
-            header = response.info().getheader("Content-Type")
+            response = yield self._fetch(filename, "HEAD", self.timeout)
+            content_type = response.headers.get("Content-Type", "application/octet-stream")
+
+        raise tornado.gen.Return(content_type)
+
+    @tornado.gen.coroutine
+    def _fetch(self, filename, method, timeout):
+        """ Send request for remote file, return response. """
+        url = urlparse.urljoin(self.url, filename)
+        client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            response = yield client.fetch(url, method=method, connect_timeout=timeout, request_timeout=timeout)
+        except tornado.httpclient.HTTPError, e:
+            if e.code in (403, 404):
+                raise WebEpicsWarning("Failed to fetch file: {0} ({1})".format(url, str(e)), e.code)
+            raise WebEpicsWarning("Failed to fetch file: {0} ({1})".format(url, str(e)))
+        except Exception, e:
+            raise WebEpicsWarning("Failed to fetch file: {0} ({1})".format(url, str(e)))
+        raise tornado.gen.Return(response)
+
+# Converter classes by file type
+CONVERTERS = {
+    "opi": opi.Converter,
+    "bob": bob.Converter
+}
+
+# Converters of conversion worker process, see _getWorkerConverter()
+_workerConverters = {}
+
+def _convert(converter, orig):
+    """ Return HTML of original file and time spent parsing and rendering it. """
+    t0 = time.time()
+    display = converter.parse(orig)
+    t1 = time.time()
+    html = converter.render(display) # Don't pass run-time macros
+    return (html, t1 - t0, time.time() - t1)
+
+def _getWorkerConverter(filetype, templates, caching):
+    """ Return converter of conversion worker process, create it and load all its templates when needed. """
+    converter = _workerConverters.get(filetype)
+    if converter is None:
+        converter = CONVERTERS[filetype](templates, caching)
+        for name in sorted(os.listdir(converter.templates.root)):
+            if name.endswith(".tmpl"):
+                try:
+                    converter.templates.load(name)
+                except Exception, e:
+                    log.warn("Failed to load template {0}: {1}".format(name, str(e)))
+        _workerConverters[filetype] = converter
+    return converter
+
+def _convertInWorker(filetype, templates, caching, orig):
+    """ Same as _convert(), runs in conversion worker process. """
+    return _convert(_getWorkerConverter(filetype, templates, caching), orig)
+
+def _warmWorker(converterArgs):
+    """ Create all converters in conversion worker process before it gets any file.
+
+    Best-effort, one worker may pick more than one warm-up call and leave
+    another worker to create converters with its first file.
+    """
+    for filetype, (templates, caching) in converterArgs.iteritems():
+        _getWorkerConverter(filetype, templates, caching)
+
+def convertFile(ctx, filename, fileTime):
+    """ Convert original file to HTML, save it to caches and return it.
+
+    Converter is selected based on file extension. Conversion runs in a
+    pool of worker processes when configured, so that large files don't
+    stall the IOLoop. fileTime is modification time of the original file
+    to be saved with result in memory cache. Returns a future resolving
+    to HTML compiled for run-time macros replacement, which raises
+    exception when file can not be loaded or converted.
+
+    Concurrent requests for the same file share single conversion, unless
+    the file was modified after conversion in progress has started or the
+    conversion is running for longer than worker_timeout.
+    """
+    pending = ctx["convert_pending"].get(filename)
+    if pending is not None and pending[1] >= fileTime:
+        return pending[0]
+
+    future = _convertFile(ctx, filename, fileTime)
+    ctx["convert_pending"][filename] = (future, fileTime)
+    ioloop = tornado.ioloop.IOLoop.current()
+    def expired():
+        if ctx["convert_pending"].get(filename, (None,))[0] is future:
+            del ctx["convert_pending"][filename]
+    deadline = ioloop.call_later(ctx["worker_timeout"], expired)
+    def done(future):
+        ioloop.remove_timeout(deadline)
+        expired()
+    future.add_done_callback(done)
+    return future
+
+def _startWorkers(ctx):
+    """ Create new pool of conversion processes and save it to context. """
+    # Pool forks workers on first submit, they must not inherit SIGUSR1 handler
+    handler = signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    try:
+        ctx["executor"] = concurrent.futures.ProcessPoolExecutor(ctx["workers"])
+        def warmed(future):
+            if future.exception() is not None:
+                log.warn("Failed to prepare conversion worker: {0}".format(str(future.exception())))
+        for _ in range(ctx["workers"]):
+            ctx["executor"].submit(_warmWorker, ctx["converter_args"]).add_done_callback(warmed)
+    finally:
+        signal.signal(signal.SIGUSR1, handler)
+
+def _restartWorkers(ctx, executor):
+    """ Replace pool of conversion processes that stopped responding.
+
+    Other conversions that timed out on the same pool don't restart it again.
+    Conversions still in progress in the old pool will time out.
+    """
+    if ctx["executor"] is not executor:
+        return
+    # Pool has no way to stop stuck worker, terminate its processes directly
+    for process in list(executor._processes):
+        process.terminate()
+    # Management thread of old pool never finishes, don't wait for it at exit
+    thread = executor._queue_management_thread
+    executor.shutdown(wait=False)
+    concurrent.futures.process._threads_queues.pop(thread, None)
+    _startWorkers(ctx)
+
+@tornado.gen.coroutine
+def _convertFile(ctx, filename, fileTime):
+    """ Do the conversion for convertFile(). """
+    _, extension = os.path.splitext(filename)
+    filetype = extension.strip(".").lower()
+    memoryCache = ctx["memory_cache"]
+    version = memoryCache.getVersion() if memoryCache is not None else None
+
+    # Load original file and convert it using selected converter
+    orig = yield ctx["loader"].get(filename)
+    executor = ctx["executor"]
+    try:
+        if executor is None:
+            html, parseTime, renderTime = _convert(ctx["converters"][filetype], orig)
+        else:
+            templates, caching = ctx["converter_args"][filetype]
+            future = executor.submit(_convertInWorker, filetype, templates, caching, orig)
+            html, parseTime, renderTime = yield tornado.gen.with_timeout(datetime.timedelta(seconds=ctx["worker_timeout"]), future)
+    except tornado.gen.TimeoutError:
+        # Worker is stuck or died, pool would never return the result
+        convertStats["errors"] += 1
+        log.error("Conversion of {0} timed out, restarting conversion workers".format(filename))
+        _restartWorkers(ctx, executor)
+        raise
+    except Exception:
+        convertStats["errors"] += 1
+        raise
+    parseTiming.observe(parseTime)
+    renderTiming.observe(renderTime)
+    convertStats["conversions"] += 1
+
+    # Save to cache, memory keeps HTML compiled for replacing macros
+    if ctx["cache"]:
+        ctx["cache"].save(filename, html)
+    template = ctx["converters"][filetype].compileMacros(html)
+    if memoryCache is not None:
+        memoryCache.put(filename, template, fileTime, size=template.getSize(), version=version)
+
+    raise tornado.gen.Return(template)
+
+@tornado.gen.coroutine
+def reconvertFile(ctx, filename):
+    """ Convert changed file in the background so that it's ready when requested. """
+    ctx["reconvert_pending"].pop(filename, None)
+    try:
+        fileTime = yield ctx["loader"].getModifiedTime(filename)
+        yield convertFile(ctx, filename, fileTime)
+        log.debug("Converted changed file {0}".format(filename))
+    except Exception, e:
+        # Whoever requests it will get the error
+        log.debug("Failed to convert changed file {0}: {1}".format(filename, str(e)))
 
 class ConvertHandler(tornado.web.RequestHandler):
     """ Extended Tornado handler for converting files on-the-fly.
@@ -263,7 +570,9 @@ class ConvertHandler(tornado.web.RequestHandler):
 
         if "files" not in cfg or "path" not in cfg["files"]:
             raise common.WebEpicsError("Configuration error: invalid 'files' setup")
-        ctx["loader"] = FileLoader(cfg["files"]["path"])
+        ctx["loader"] = FileLoader(cfg["files"]["path"],
+                                   float(cfg["files"].get("timeout", 2.0)),
+                                   int(cfg["files"].get("max_requests", 10)))
         log.info("Convertable files path: {0}".format(cfg["files"]["path"]))
 
         if "cache" not in cfg or "path" not in cfg["cache"] or cfg["cache"]["path"] is "":
@@ -272,32 +581,101 @@ class ConvertHandler(tornado.web.RequestHandler):
         else:
             ctx["cache"] = FileCache(cfg["cache"]["path"])
             log.info("Cache base dir: {0}".format(cfg["cache"]["path"]))
+
+        # Memory tier is only used together with disk cache
+        memoryCache.max_bytes = int(cfg.get("memory_cache", {}).get("size", 64*1024*1024))
+        ctx["memory_cache"] = memoryCache if ctx["cache"] and memoryCache.max_bytes > 0 else None
+
+        # Watcher is started by watchFiles() once processes are forked
+        ctx["watch"] = bool(cfg["files"].get("watch", False))
+        ctx["watch_delay"] = float(cfg["files"].get("watch_delay", 0.5))
+        ctx["watcher"] = None
+        ctx["reconvert_pending"] = {}
         ctx["wsUrlPattern"] = wsUrlPattern
 
-        # Setup converters
+        # Setup converters, worker processes create their own
         ctx["converters"] = {}
-        if "opi" in cfg:
-            if "templates" not in cfg["opi"]:
-                log.error("Configuration error: missing 'opi/templates' directive")
-            else:
-                ctx["converters"]["opi"] = opi.Converter(cfg["opi"]["templates"], ctx["cache"] != None)
-                log.info("Loaded .opi file converter")
-        if "bob" in cfg:
-            if "templates" not in cfg["bob"]:
-                log.error("Configuration error: missing 'bob/templates' directive")
+        ctx["converter_args"] = {}
+        for filetype in sorted(CONVERTERS):
+            if filetype not in cfg:
+                continue
+            if "templates" not in cfg[filetype]:
+                log.error("Configuration error: missing '{0}/templates' directive".format(filetype))
             else:
-                ctx["converters"]["bob"] = bob.Converter(cfg["bob"]["templates"], ctx["cache"] != None)
-                log.info("Loaded .bob file converter")
+                ctx["converter_args"][filetype] = (cfg[filetype]["templates"], ctx["cache"] != None)
+                ctx["converters"][filetype] = CONVERTERS[filetype](*ctx["converter_args"][filetype])
+                log.info("Loaded .{0} file converter".format(filetype))
+
+        # Pool of conversion processes, created by startWorkers()
+        ctx["workers"] = int(cfg.get("workers", 2))
+        ctx["worker_timeout"] = float(cfg.get("worker_timeout", 60.0))
+        ctx["executor"] = None
+
+        # Conversions in progress by file name, see convertFile()
+        ctx["convert_pending"] = {}
 
         return ctx
 
+    @staticmethod
+    def startWorkers(ctx):
+        """ Start pool of conversion processes, if enabled in configuration.
+
+        Must be called in every web server process right after they're
+        forked, before any threads are started. Workers are forked right
+        away and usually load converter templates before the first file
+        comes in.
+        Files are converted in IOLoop when there's no pool.
+        """
+        if ctx["workers"] <= 0 or ctx["executor"] is not None:
+            return
+
+        _startWorkers(ctx)
+        log.info("Started {0} conversion workers".format(ctx["workers"]))
+
+    @staticmethod
+    def watchFiles(ctx):
+        """ Start watching original files for changes, if enabled in configuration.
+
+        Changed files are removed from memory cache and the ones that were
+        cached are converted again in the background. Must be called in
+        every web server process after they're forked.
+        """
+        if not ctx["watch"]:
+            return
+        if ctx["loader"].isRemote() or ctx["memory_cache"] is None:
+            log.warn("Watching files only works with local files and memory cache enabled")
+            return
+
+        memoryCache = ctx["memory_cache"]
+        ioloop = tornado.ioloop.IOLoop.current()
+        def onChange(filename):
+            if filename is None:
+                memoryCache.invalidate(None)
+                if not ctx["watcher"].isActive():
+                    ctx["watcher"] = None
+            elif memoryCache.invalidate(filename):
+                # Editors save files in multiple steps, give them some time
+                timeout = ctx["reconvert_pending"].pop(filename, None)
+                if timeout is not None:
+                    ioloop.remove_timeout(timeout)
+                ctx["reconvert_pending"][filename] = ioloop.call_later(ctx["watch_delay"], reconvertFile, ctx, filename)
+
+        try:
+            ctx["watcher"] = watcher.Watcher(ctx["loader"].dir, onChange)
+        except OSError, e:
+            log.warn("Not watching files for changes: {0}".format(str(e)))
+
     def initialize(self, ctx):
         """ Called by Tornado before every request, the only place to pass in ctx. """
+        self.ctx = ctx
+        self.watcher = ctx["watcher"]
         self.loader = ctx["loader"]
         self.cache = ctx["cache"]
+        self.memoryCache = ctx["memory_cache"]
         self.converters = ctx["converters"]
         self.wsUrlPattern = ctx["wsUrlPattern"]
 
+    @tornado.gen.coroutine
     def get(self):
         """ Overloaded Tornado get() handler.
 
@@ -322,34 +700,61 @@ class ConvertHandler(tornado.web.RequestHandler):
 
         # Pass through files without converter
         if filetype not in self.converters:
-            self.getStaticFile(filename)
+            convertStats["static"] += 1
+            yield self.getStaticFile(filename)
             return
 
-        # Get last modified time but also determine whether file exists.
-        # Otherwise quit with 404 error. All other exceptions in this function
-        # turn into 500 Internal error.
-        try:
-            fileTime = self.loader.getModifiedTime(filename)
-        except WebEpicsWarning, e:
-            if e.error:
-                raise tornado.web.HTTPError(status_code=e.error)
-            raise
-
-        # Hopefully we've generated the file in the past that we can reuse
-        if self.cache and fileTime <= self.cache.getModifiedTime(filename):
-            html = self.cache.read(filename)
+        convertStats["requests"] += 1
+        filename = os.path.normpath(filename)
+
+        # Watcher invalidates changed files, when watching files are served
+        # from memory without checking whether they've been modified
+        template = None
+        t1 = time.time()
+        if self.memoryCache is not None and self.watcher is not None:
+            template = self.memoryCache.get(filename)
+
+        if template is None:
+            # Get last modified time but also determine whether file exists.
+            # Otherwise quit with 404 error. All other exceptions in this function
+            # turn into 500 Internal error.
+            t0 = time.time()
+            try:
+                fileTime = yield self.loader.getModifiedTime(filename)
+            except WebEpicsWarning, e:
+                if e.error:
+                    raise tornado.web.HTTPError(status_code=e.error)
+                raise
+            t1 = time.time()
+            mtimeTiming.observe(t1 - t0)
+
+            # Hopefully we've generated the file in the past that we can reuse,
+            # popular files are served from memory without touching the disk
+            if self.memoryCache is not None and self.watcher is None:
+                template = self.memoryCache.get(filename, fileTime)
+
+        if template is not None:
+            convertStats["cache_hits"] += 1
+            t0 = time.time()
+            cacheReadTiming.observe(t0 - t1)
+        elif self.cache and fileTime <= self.cache.getModifiedTime(filename):
+            version = self.memoryCache.getVersion() if self.memoryCache is not None else None
+            template = self.converters[filetype].compileMacros(self.cache.read(filename))
+            if self.memoryCache is not None:
+                self.memoryCache.put(filename, template, fileTime, size=template.getSize(), version=version)
+            convertStats["cache_hits"] += 1
+            t0 = time.time()
+            cacheReadTiming.observe(t0 - t1)
         else:
-            # Load original file and convert it using selected converter
-            orig = self.loader.get(filename)
+            if self.cache:
+                convertStats["cache_misses"] += 1
+
             try:
-                html = self.converters[filetype].getHtml(orig) # Don't pass run-time macros
+                template = yield convertFile(self.ctx, filename, fileTime)
             except Exception, e:
                 log.error(str(e))
                 raise tornado.web.HTTPError(status_code=500)
-
-            # Save to cache
-            if self.cache:
-                self.cache.save(filename, html)
+            t0 = time.time()
 
         # Replace run-time macros
         # request.arguments is a dictionary of lists in case multiple
@@ -362,11 +767,14 @@ class ConvertHandler(tornado.web.RequestHandler):
         # Push WebSocket server URL as run-time macro
         macros["WEBSOCKET_URL"] = self.getWebSocketUrl()
 
-        html = self.converters[filetype].replaceMacros(html, macros)
+        # Macro slots were found when file was cached, this is a single pass
+        html = template.replace(macros)
+        macrosTiming.observe(time.time() - t0)
 
         # We're done
         self.write(html)
 
+    @tornado.gen.coroutine
     def getStaticFile(self, filename):
         """ Load a file using FileLoader without processing. """
 
@@ -374,8 +782,10 @@ class ConvertHandler(tornado.web.RequestHandler):
             raise RuntimeError("Not yet implemented")
         else:
             try:
-                self.set_header("Content-Type", self.loader.getContentType(filename))
-                self.write(self.loader.get(filename))
+                content_type = yield self.loader.getContentType(filename)
+                data = yield self.loader.get(filename)
+                self.set_header("Content-Type", content_type)
+                self.write(data)
             except WebEpicsWarning, e:
                 if e.error:
                     raise tornado.web.HTTPError(status_code=e.error)
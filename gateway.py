@@ -0,0 +1,454 @@
+# gateway.py
+#
+# Copyright (c) 2017 Oak Ridge National Laboratory.
+# All rights reserved.
+# See file LICENSE that is included with this distribution.
+#
+# @author Klemen Vodopivec
+#
+
+"""
+PV gateway shares EPICS channels among all web server processes.
+
+When web server runs in multiple processes, each process would open its own
+channel and monitor for every PV its clients use. With gateway enabled, one
+gateway process owns all the channels. Web server processes subscribe to PVs
+through a local Unix socket and receive pv_update messages that gateway
+encodes only once for all of them.
+
+Messages in both directions are JSON strings prefixed by 32-bit big-endian
+length. Web server process sends subscribe, unsubscribe, get and put
+requests, gateway responds with pv_update, get and put messages.
+
+Web server process that doesn't read fast enough loses oldest pv_update
+messages once max_buffer bytes are queued for it, PVs with lost updates
+are sent in full when it catches up. Spawned gateway exits when the web
+server process that spawned it is gone.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+
+import backend
+import config
+import timing
+import websocket
+from common import PvValue, WebEpicsError, WebEpicsWarning
+
+log = logging.getLogger(__name__)
+
+def encodeMessage(message):
+    """ Return message with length prefix, message is a dictionary or already encoded JSON string. """
+    if isinstance(message, dict):
+        message = json.dumps(message)
+    return struct.pack(">I", len(message)) + message
+
+def writeMessage(stream, message):
+    """ Send message to stream, message is a dictionary or already encoded JSON string. """
+    stream.write(encodeMessage(message))
+
+@tornado.gen.coroutine
+def readMessage(stream):
+    """ Read one message from stream and return it decoded. """
+    header = yield stream.read_bytes(4)
+    length, = struct.unpack(">I", header)
+    data = yield stream.read_bytes(length)
+    raise tornado.gen.Return(json.loads(data))
+
+##############################################################################
+### Gateway process side                                                  ###
+##############################################################################
+
+class GatewayConnection():
+    """ Connection from one web server process.
+
+    Acts as a client of shared PV objects, the same way as WebSocketHandler
+    does in web server process without gateway.
+
+    Messages are queued and written to stream one batch at a time. PV
+    updates are dropped oldest first when more than max_buffer bytes are
+    queued, PVs with dropped updates are then sent in full after next batch
+    is written.
+    """
+
+    def __init__(self, stream, ctx, clientId, maxBuffer):
+        self._stream = stream
+        self._ctx = ctx
+        self._clientId = clientId
+        self._pvs = {}
+        self._fields = {}
+
+        self._maxBuffer = maxBuffer
+        self._responses = []
+        self._updates = collections.deque()
+        self._queuedBytes = 0
+        self._dirty = set()
+        self._writing = False
+
+    @tornado.gen.coroutine
+    def run(self):
+        """ Process requests until web server process disconnects. """
+        try:
+            while True:
+                message = yield readMessage(self._stream)
+                self.handleRequest(message)
+        except tornado.iostream.StreamClosedError:
+            log.info("Web server process {0} disconnected".format(self._clientId))
+        finally:
+            self.close()
+
+    def close(self):
+        """ Unsubscribe from all PVs. """
+        websocket.unsubscribeAll(self, self._pvs.itervalues())
+        self._pvs = {}
+
+    def getClientId(self):
+        """ Return client ID useful for log. """
+        return self._clientId
+
+    def handleRequest(self, message):
+        """ Process single request from web server process. """
+        try:
+            req = message["req"]
+            pvurl = message["pv"]
+            if req == "subscribe":
+                pv = self._pvs.get(pvurl, websocket.pvs.get(pvurl))
+                if pv is None:
+                    pv = websocket.createPV(self._ctx, pvurl)
+                    websocket.pvs[pvurl] = pv
+                self._pvs[pvurl] = pv
+                self._fields[pvurl] = websocket.parseFields(message.get("fields"))
+                pv.subscribe(self, self._fields[pvurl])
+            elif req == "unsubscribe":
+                pv = self._pvs.pop(pvurl, None)
+                self._fields.pop(pvurl, None)
+                self._dirty.discard(pvurl)
+                if pv is not None:
+                    pv.unsubscribe(self)
+            elif req == "get":
+                self._get(message)
+            elif req == "put":
+                self._put(message)
+            else:
+                log.warn("Unknown gateway request: {0}".format(req))
+        except Exception, e:
+            log.error("Gateway request failed: {0}".format(str(e)))
+
+    @tornado.gen.coroutine
+    def _get(self, message):
+        """ Handles get request and sends back the value or error status. """
+        timeout = message.get("timeout")
+        if timeout is None:
+            timeout = self._ctx["get_timeout"]
+        rsp = { "rsp": "get", "id": message["id"], "status": "success" }
+        try:
+            rsp["value"] = yield websocket.getValue(self._ctx, message["pv"], None, float(timeout))
+        except Exception, e:
+            rsp["status"] = "error: {0}".format(str(e))
+        self._send(rsp)
+
+    @tornado.gen.coroutine
+    def _put(self, message):
+        """ Handles put request and sends back the status. """
+        timeout = message.get("timeout")
+        if timeout is None:
+            timeout = self._ctx["put_timeout"]
+        status = yield websocket.putValue(self._ctx, message["pv"], message["value"], float(timeout))
+        self._send({ "rsp": "put", "id": message["id"], "status": status })
+
+    def onPvUpdate(self, pvurl, update, encoded=None):
+        """ Forward PV update to web server process. """
+        if encoded is None:
+            encoded = websocket.EncodedUpdate(pvurl, update)
+        self._send(encoded.getJson(), pvurl)
+
+    def _send(self, message, pvurl=None):
+        """ Queue message for web server process, pvurl is given for PV updates that can be dropped. """
+        data = encodeMessage(message)
+        if pvurl is None:
+            self._responses.append(data)
+        else:
+            self._updates.append( (pvurl, data) )
+        self._queuedBytes += len(data)
+
+        if self._queuedBytes > self._maxBuffer and self._updates:
+            if not self._dirty:
+                log.warn("Web server process {0} can't keep up, dropping PV updates".format(self._clientId))
+            while self._queuedBytes > self._maxBuffer and self._updates:
+                dropped, data = self._updates.popleft()
+                self._queuedBytes -= len(data)
+                self._dirty.add(dropped)
+
+        if not self._writing:
+            self._flush()
+
+    @tornado.gen.coroutine
+    def _flush(self):
+        """ Write queued messages in batches until queue is empty. """
+        self._writing = True
+        try:
+            while self._responses or self._updates:
+                data = "".join(self._responses) + "".join(data for _, data in self._updates)
+                self._responses = []
+                self._updates.clear()
+                self._queuedBytes = 0
+                yield self._stream.write(data)
+
+                # Send dropped PVs in full, when dropped again they remain dirty
+                dirty, self._dirty = self._dirty, set()
+                for pvurl in dirty:
+                    pv = self._pvs.get(pvurl)
+                    if pv is not None and pv.getCached():
+                        update = websocket.filterUpdate(pv.getCached(), self._fields[pvurl])
+                        self._send(websocket.EncodedUpdate(pvurl, update).getJson(), pvurl)
+        except tornado.iostream.StreamClosedError:
+            # run() will take care of unsubscribing
+            pass
+        finally:
+            self._writing = False
+
+class GatewayServer(tornado.tcpserver.TCPServer):
+    """ Accepts connections from web server processes. """
+
+    def __init__(self, ctx, maxBuffer):
+        super(GatewayServer, self).__init__()
+        self._ctx = ctx
+        self._maxBuffer = maxBuffer
+        self._connections = 0
+
+    def handle_stream(self, stream, address):
+        self._connections += 1
+        clientId = "process{0}".format(self._connections)
+        log.info("Web server process {0} connected".format(clientId))
+        return GatewayConnection(stream, self._ctx, clientId, self._maxBuffer).run()
+
+def run(cfg, parentPid=None):
+    """ Run gateway in this process.
+
+    Never returns when parentPid is None, otherwise returns when process
+    parentPid is no longer its parent.
+    """
+    ctx = websocket.WebSocketHandler.createContext(cfg["websocket"])
+    ctx["channel_factory"] = backend.createChannelFactory(cfg["backend"])
+    server = GatewayServer(ctx, int(cfg["gateway"].get("max_buffer", 4*1024*1024)))
+    server.add_socket(tornado.netutil.bind_unix_socket(cfg["gateway"]["socket"]))
+    log.info("PV gateway listening on {0}".format(cfg["gateway"]["socket"]))
+    timing.installSignalHandler()
+
+    ioloop = tornado.ioloop.IOLoop.current()
+    if parentPid is not None:
+        def checkParent():
+            if os.getppid() != parentPid:
+                log.warn("Web server process {0} exited, stopping PV gateway".format(parentPid))
+                ioloop.stop()
+        tornado.ioloop.PeriodicCallback(checkParent, 1000).start()
+    ioloop.start()
+
+def spawn(cfg):
+    """ Fork gateway process, must be called before any IOLoop is created.
+
+    Gateway exits when this process exits.
+    """
+    parentPid = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run(cfg, parentPid)
+        except Exception, e:
+            log.critical("PV gateway failed: {0}".format(str(e)))
+        finally:
+            os._exit(0)
+    log.info("Started PV gateway process {0}".format(pid))
+    return pid
+
+##############################################################################
+### Web server process side                                                ###
+##############################################################################
+
+class RemoteChannel():
+    """ Channel to PV provided by gateway, follows pvaccess.Channel interface.
+
+    Gateway sends only changes, channel merges them into full PV structure
+    which is passed to monitor callback just like pvaccess would.
+    """
+
+    def __init__(self, client, pvurl):
+        self._client = client
+        self._pvurl = pvurl
+        self._callback = None
+        self._value = {}
+        self._timeout = None
+
+    def getUrl(self):
+        return self._pvurl
+
+    def subscribe(self, name, callback):
+        self._callback = callback
+
+    def unsubscribe(self, name):
+        self._callback = None
+        self._client.unsubscribe(self)
+
+    def startMonitor(self, request="field()"):
+        fields = request.strip()[len("field("):-1]
+        self._value = {}
+        self._client.subscribe(self, fields.split(",") if fields else None)
+
+    def stopMonitor(self):
+        # Gateway is notified in unsubscribe() or startMonitor()
+        pass
+
+    def setTimeout(self, timeout):
+        self._timeout = timeout
+
+    def get(self):
+        return PvValue(self._client.get(self._pvurl, self._timeout))
+
+    def put(self, value):
+        self._client.put(self._pvurl, value, self._timeout)
+
+    def toDict(self):
+        # Copy like pvaccess does, merging next update must not change it
+        return websocket.mergeUpdate({}, self._value)
+
+    def onUpdate(self, update):
+        """ Called by GatewayClient when gateway sends PV update. """
+        websocket.mergeUpdate(self._value, update)
+        if self._callback is not None:
+            self._callback(self)
+
+class GatewayClient():
+    """ Connection from web server process to gateway.
+
+    Connects to gateway in the background and keeps reconnecting when
+    connection is lost. All active subscriptions are renewed on reconnect.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._stream = None
+        self._channels = {}
+        self._requests = {}
+        self._requestId = 0
+        self._ioloop = tornado.ioloop.IOLoop.current()
+        self._ioloop.add_callback(self._run)
+
+    def createChannel(self, pvurl):
+        """ Channel factory to be used by websocket.PV objects. """
+        return RemoteChannel(self, pvurl)
+
+    def subscribe(self, channel, fields):
+        self._channels[channel.getUrl()] = (channel, fields)
+        self._send({ "req": "subscribe", "pv": channel.getUrl(), "fields": fields })
+
+    def unsubscribe(self, channel):
+        entry = self._channels.get(channel.getUrl())
+        if entry is not None and entry[0] is channel:
+            del self._channels[channel.getUrl()]
+            self._send({ "req": "unsubscribe", "pv": channel.getUrl() })
+
+    def get(self, pvurl, timeout=None):
+        """ Get value through gateway, blocking call to be run in executor thread. """
+        return self._request({ "req": "get", "pv": pvurl, "timeout": timeout }, timeout)["value"]
+
+    def put(self, pvurl, value, timeout=None):
+        """ Put value through gateway, blocking call to be run in executor thread. """
+        self._request({ "req": "put", "pv": pvurl, "value": value, "timeout": timeout }, timeout)
+
+    def _request(self, request, timeout):
+        """ Send request from executor thread and wait for successful response. """
+        future = concurrent.futures.Future()
+        self._ioloop.add_callback(self._sendRequest, request, future)
+        rsp = future.result(timeout)
+        if rsp.get("status") != "success":
+            raise WebEpicsWarning(str(rsp.get("status")).replace("error: ", "", 1))
+        return rsp
+
+    def _sendRequest(self, request, future):
+        if self._stream is None:
+            future.set_exception(WebEpicsWarning("Not connected to PV gateway"))
+            return
+        self._requestId += 1
+        self._requests[self._requestId] = future
+        request["id"] = self._requestId
+        self._send(request)
+
+    def _send(self, message):
+        if self._stream is not None:
+            try:
+                writeMessage(self._stream, message)
+            except tornado.iostream.StreamClosedError:
+                pass
+
+    @tornado.gen.coroutine
+    def _run(self):
+        """ Maintain connection to gateway and dispatch received messages. """
+        delay = 0.1
+        while True:
+            stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            try:
+                yield stream.connect(self._path)
+            except (socket.error, tornado.iostream.StreamClosedError), e:
+                log.debug("Failed to connect to PV gateway: {0}".format(str(e)))
+                yield tornado.gen.sleep(delay)
+                delay = min(5.0, delay * 2)
+                continue
+
+            log.info("Connected to PV gateway {0}".format(self._path))
+            delay = 0.1
+            self._stream = stream
+            for pvurl, (channel, fields) in self._channels.items():
+                self._send({ "req": "subscribe", "pv": pvurl, "fields": fields })
+
+            try:
+                while True:
+                    message = yield readMessage(stream)
+                    self._handleMessage(message)
+            except tornado.iostream.StreamClosedError:
+                log.warn("Lost connection to PV gateway")
+
+            self._stream = None
+            requests, self._requests = self._requests, {}
+            for future in requests.itervalues():
+                future.set_exception(WebEpicsWarning("Lost connection to PV gateway"))
+
+    def _handleMessage(self, message):
+        rsp = message.pop("rsp", None)
+        if rsp == "pv_update":
+            entry = self._channels.get(message.pop("pv", None))
+            # Sequence numbers are assigned again by web server process PV
+            message.pop("seq", None)
+            if entry is not None:
+                entry[0].onUpdate(message)
+        elif rsp in ("get", "put"):
+            future = self._requests.pop(message.get("id"), None)
+            if future is not None:
+                future.set_result(message)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebEPICS PV gateway")
+    parser.add_argument("-c", "--config", help="Configuration file", default="webepics.conf")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+
+    try:
+        cfg = config.load(args.config)
+    except WebEpicsError, e:
+        logging.critical(str(e))
+        sys.exit(1)
+
+    run(cfg)
@@ -0,0 +1,159 @@
+# metrics.py
+#
+# Copyright (c) 2017 Oak Ridge National Laboratory.
+# All rights reserved.
+# See file LICENSE that is included with this distribution.
+#
+# @author Klemen Vodopivec
+
+"""
+Runtime statistics in Prometheus text exposition format.
+
+Measured objects only increment plain counters as they go, nothing is
+calculated until /metrics is requested. Rates are left to Prometheus, all
+the counters are monotonic. When web server runs in multiple processes,
+each process reports its own numbers.
+"""
+
+import tornado.web
+
+import convert
+import timing
+import websocket
+
+def escapeLabel(value):
+    """ Return label value escaped as required by exposition format. """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatMetric(name, mtype, help, samples):
+    """ Return lines describing single metric.
+
+    samples is a list of (labels, value) tuples where labels is a dictionary
+    or None.
+    """
+    lines = [ "# HELP {0} {1}".format(name, help), "# TYPE {0} {1}".format(name, mtype) ]
+    for labels, value in samples:
+        if labels:
+            labels = ",".join('{0}="{1}"'.format(k, escapeLabel(v)) for k, v in sorted(labels.iteritems()))
+            lines.append("{0}{{{1}}} {2}".format(name, labels, repr(value)))
+        else:
+            lines.append("{0} {1}".format(name, repr(value)))
+    return lines
+
+def formatHistogram(name, help, histogram):
+    """ Return lines describing timing.Histogram object. """
+    lines = [ "# HELP {0} {1}".format(name, help), "# TYPE {0} histogram".format(name) ]
+    total = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        total += count
+        lines.append('{0}_bucket{{le="{1}"}} {2}'.format(name, repr(bound), total))
+    lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(name, histogram.count))
+    lines.append("{0}_sum {1}".format(name, repr(histogram.sum)))
+    lines.append("{0}_count {1}".format(name, histogram.count))
+    return lines
+
+def collect():
+    """ Return all metrics as a single string. """
+    lines = []
+
+    # PVs
+    totals = dict(websocket.retiredStats)
+    perPv = { "subscribers": [], "queued": [], "dropped": [], "updates": [], "process_seconds": [] }
+    for pvurl, pv in websocket.pvs.items():
+        labels = { "pv": pvurl }
+        perPv["subscribers"].append( (labels, pv.getClientCount()) )
+        for key in totals:
+            totals[key] += pv.stats[key]
+            perPv[key].append( (labels, pv.stats[key]) )
+
+    lines += formatMetric("webepics_pvs", "gauge", "Number of PV objects, including idle ones",
+                          [ (None, len(websocket.pvs)) ])
+    lines += formatMetric("webepics_pv_subscribers", "gauge", "Number of clients subscribed to PV",
+                          perPv["subscribers"])
+    lines += formatMetric("webepics_pv_received_total", "counter", "Monitor updates received from PV",
+                          perPv["queued"])
+    lines += formatMetric("webepics_pv_dropped_total", "counter", "Monitor updates dropped because PV queue was full",
+                          perPv["dropped"])
+    lines += formatMetric("webepics_pv_updates_total", "counter", "Changes of PV sent to subscribed clients",
+                          perPv["updates"])
+    lines += formatMetric("webepics_pv_process_seconds_total", "counter", "Time spent processing PV updates",
+                          perPv["process_seconds"])
+    lines += formatMetric("webepics_received_total", "counter", "Monitor updates received from all PVs",
+                          [ (None, totals["queued"]) ])
+    lines += formatMetric("webepics_dropped_total", "counter", "Monitor updates dropped from all PVs",
+                          [ (None, totals["dropped"]) ])
+    lines += formatMetric("webepics_updates_total", "counter", "Changes of all PVs sent to subscribed clients",
+                          [ (None, totals["updates"]) ])
+    lines += formatMetric("webepics_process_seconds_total", "counter", "Time spent processing updates of all PVs",
+                          [ (None, totals["process_seconds"]) ])
+
+    # Idle PV pool
+    pool = websocket.pool
+    lines += formatMetric("webepics_pool_idle", "gauge", "Number of idle PVs with channel kept open",
+                          [ (None, len(pool)) ])
+    for key in sorted(pool.stats):
+        lines += formatMetric("webepics_pool_{0}_total".format(key), "counter", "Idle PV pool {0}".format(key),
+                              [ (None, pool.stats[key]) ])
+
+    # Sessions of disconnected clients
+    sessions = websocket.sessions
+    lines += formatMetric("webepics_sessions_detached", "gauge", "Number of sessions waiting for client to reconnect",
+                          [ (None, len(sessions)) ])
+    for key in sorted(sessions.stats):
+        lines += formatMetric("webepics_sessions_{0}_total".format(key), "counter", "Sessions {0}".format(key),
+                              [ (None, sessions.stats[key]) ])
+
+    # WebSocket clients
+    buffers = [ client.getWriteBufferSize() for client in websocket.clients ]
+    lines += formatMetric("webepics_ws_clients", "gauge", "Number of connected WebSocket clients",
+                          [ (None, len(buffers)) ])
+    lines += formatMetric("webepics_ws_clients_degraded", "gauge", "Number of clients in latest-value-only mode",
+                          [ (None, websocket.clientStats["degraded"]) ])
+    lines += formatMetric("webepics_ws_stalled_disconnects_total", "counter", "Clients disconnected for being stalled",
+                          [ (None, websocket.clientStats["stalled_disconnects"]) ])
+    lines += formatMetric("webepics_ws_messages_sent_total", "counter", "WebSocket messages sent to clients",
+                          [ (None, websocket.clientStats["messages_sent"]) ])
+    lines += formatMetric("webepics_ws_sent_bytes_total", "counter", "Bytes of WebSocket messages sent to clients",
+                          [ (None, websocket.clientStats["bytes_sent"]) ])
+    lines += formatMetric("webepics_ws_write_buffer_bytes", "gauge", "Bytes queued for all clients but not yet sent",
+                          [ (None, sum(buffers)) ])
+    lines += formatMetric("webepics_ws_write_buffer_max_bytes", "gauge", "Largest number of bytes queued for single client",
+                          [ (None, max(buffers) if buffers else 0) ])
+
+    # File conversion
+    stats = convert.convertStats
+    lines += formatMetric("webepics_convert_requests_total", "counter", "Requests for files with converter",
+                          [ (None, stats["requests"]) ])
+    lines += formatMetric("webepics_convert_static_total", "counter", "Requests for files passed through unchanged",
+                          [ (None, stats["static"]) ])
+    lines += formatMetric("webepics_convert_conversions_total", "counter", "Files converted to HTML",
+                          [ (None, stats["conversions"]) ])
+    lines += formatMetric("webepics_convert_errors_total", "counter", "Files that failed to convert",
+                          [ (None, stats["errors"]) ])
+    lines += formatMetric("webepics_convert_cache_hits_total", "counter", "Converted files served from cache",
+                          [ (None, stats["cache_hits"]) ])
+    lines += formatMetric("webepics_convert_cache_misses_total", "counter", "Converted files not found in cache",
+                          [ (None, stats["cache_misses"]) ])
+
+    memory = convert.memoryCache
+    lines += formatMetric("webepics_convert_memory_cache_entries", "gauge", "Converted files cached in memory",
+                          [ (None, len(memory)) ])
+    lines += formatMetric("webepics_convert_memory_cache_bytes", "gauge", "Bytes of converted files cached in memory",
+                          [ (None, memory.bytes) ])
+    for key in sorted(memory.stats):
+        lines += formatMetric("webepics_convert_memory_cache_{0}_total".format(key), "counter",
+                              "Converted files memory cache {0}".format(key), [ (None, memory.stats[key]) ])
+
+    # Stage timings
+    for name, histogram in timing.histograms.items():
+        lines += formatHistogram("webepics_{0}_seconds".format(name), histogram.help, histogram)
+
+    lines.append("")
+    return "\n".join(lines)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ Tornado handler exporting runtime statistics for Prometheus. """
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(collect())
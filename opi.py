@@ -22,10 +22,31 @@ HORIZONTAL_ALIGN=["left", "center", "right"]
 VERTICAL_ALIGN=["top", "middle", "bottom"]
 FORMAT_TYPES=["%{0}b", "%{0}d", "%{0}f", "%{0}x", "%{0}b", "%{0}x", "%{0}b", "%{0}f", "%{0}f", "%{0}f", "%{0}f"]
 
+def getDeadband(fmt, precision):
+    """ Return value deadband for widget showing PV with given format, or None.
+
+    Deadband is half of the last digit shown. Client shows %d values
+    rounded to integer, and %f values with precision+1 significant digits
+    (toPrecision) regardless of their magnitude, which needs deadband
+    relative to the value. Its smallest possible value is used, for values
+    just below the next power of ten. Smaller changes can still cross a
+    rounding boundary and change what is shown, server sends them after
+    deadband_hold seconds at the latest.
+    """
+    if fmt is None or precision < 0:
+        return None
+    if fmt.endswith("f"):
+        digits = min(21, max(1, precision + 1))
+        return "{0:g}%".format(50.0 * 10 ** -digits)
+    if fmt.endswith("d"):
+        return "0.5"
+    return None
+
 class Converter:
     """ OPI convert helper class.
 
-    Implements getHtml() and replaceMacros() methods. Called from outside.
+    Implements getHtml(), parse(), render(), replaceMacros() and
+    compileMacros() methods. Called from outside.
     """
 
     def __init__(self, templates_dir, caching):
@@ -36,7 +57,15 @@ class Converter:
     def replaceMacros(self, str, macros):
         return Macros.replace(str, macros)
 
+    def compileMacros(self, html):
+        """ Return MacroTemplate for replacing run-time macros in rendered HTML. """
+        return MacroTemplate(html)
+
     def getHtml(self, xml_str, macros={}):
+        return self.render(self.parse(xml_str), macros)
+
+    def parse(self, xml_str):
+        """ Parse XML string and return top-level Display widget. """
         try:
             node = xml.dom.minidom.parseString(xml_str)
         except Exception, e:
@@ -48,7 +77,10 @@ class Converter:
         # Start with top-level Display widget
         display = Display()
         display.parse(node.documentElement)
+        return display
 
+    def render(self, display, macros={}):
+        """ Return HTML of parsed Display widget. """
         return self._renderWidget(display, macros)
 
     def _renderWidget(self, widget, macros, unique_id=1):
@@ -265,6 +297,46 @@ class Macros(xom.Model):
             str = re.sub(regex, value, str)
         return str
 
+class MacroTemplate():
+    """ Text with $(NAME) macros, prepared for fast repeated replacing.
+
+    Text is split into static segments and macro slots only once. Replacing
+    macros is then a single join of segments and macro values, regardless
+    of the number of macros given. Macros without value are left in text
+    as they are.
+    """
+
+    regex = re.compile("\$\(([^\)]*)\)")
+
+    def __init__(self, text):
+        self._parts = []
+        self._slots = []
+        pos = 0
+        for match in MacroTemplate.regex.finditer(text):
+            self._parts.append(text[pos:match.start()])
+            self._slots.append( (len(self._parts), match.group(1)) )
+            self._parts.append(match.group(0))
+            pos = match.end()
+        self._parts.append(text[pos:])
+        self._size = len(text)
+
+    def getSize(self):
+        """ Return length of original text. """
+        return self._size
+
+    def getText(self):
+        """ Return original text. """
+        return "".join(self._parts)
+
+    def replace(self, macros):
+        """ Return text with macros replaced with values from dictionary. """
+        parts = list(self._parts)
+        for i, name in self._slots:
+            value = macros.get(name)
+            if value is not None:
+                parts[i] = value
+        return "".join(parts)
+
 class Action(xom.Model):
     """ Model for a single action. """
     type = xom.String(tagname="__self__", attrname="type")
@@ -424,6 +496,7 @@ class TextUpdate(Widget):
     def parse(self, node):
         done = super(TextUpdate, self).parse(node)
 
+        deadband = None
         if self.precision_from_pv:
             fmt = None
         else:
@@ -436,8 +509,10 @@ class TextUpdate(Widget):
             if self.format_type == 5:
                 precision = 8
 
+            deadband = getDeadband(fmt, precision)
             fmt = fmt.format(precision)
         self.setField("value_format", fmt)
+        self.setField("deadband", deadband)
 
         return done
 
@@ -0,0 +1,143 @@
+# pvdiff.py
+#
+# Copyright (c) 2017 Oak Ridge National Laboratory.
+# All rights reserved.
+# See file LICENSE that is included with this distribution.
+#
+# @author Klemen Vodopivec
+
+"""
+Fast calculation of changes between consecutive PV updates.
+
+PV structure rarely changes once the channel is connected, so it is learned
+from the first update and compiled into a flat list of field paths. Every
+next update is then compared field by field in a single pass without
+recursion, making JSON-incompatible float values (NaN, +Inf, -Inf) JSON
+compliant at the same time. Array fields are compared by identity and
+length before their elements are looked at.
+"""
+
+INF = float("inf")
+
+class StructureChanged(Exception):
+    """ Raised internally when update doesn't match learned PV structure. """
+    pass
+
+class DiffEngine():
+    """ Calculates differences between consecutive updates of a single PV.
+
+    Schema is a list of (path, size, leaves) tuples, one for each nested
+    dictionary in the PV structure. path is a tuple of keys leading to
+    dictionary, size is number of its keys and leaves are keys of non
+    dictionary values. Last values of all leaves are kept in a flat list,
+    in the same order as they appear in schema.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Forget learned structure, next update will be returned in full. """
+        self._schema = None
+        self._values = None
+
+    def diff(self, d):
+        """ Return dictionary with fields that changed since previous call.
+
+        Float fields that are not JSON compliant are replaced with None in
+        d as well as in returned dictionary. First update and any update
+        with different structure than the previous one is returned in full.
+        Returned dictionary may share sub-dictionaries with d.
+        """
+        if self._schema is not None:
+            try:
+                return self._diff(d)
+            except (KeyError, TypeError, StructureChanged):
+                pass
+
+        self._compile(d)
+        return d
+
+    def _compile(self, d):
+        """ Learn PV structure from update and remember its values. """
+        schema = []
+        values = []
+
+        nodes = [ ((), d) ]
+        while nodes:
+            path, node = nodes.pop(0)
+            leaves = []
+            for key, value in node.iteritems():
+                if isinstance(value, dict):
+                    nodes.append( (path + (key,), value) )
+                else:
+                    value = sanitize(value)
+                    node[key] = value
+                    leaves.append(key)
+                    values.append(value)
+            schema.append( (path, len(node), tuple(leaves)) )
+
+        self._schema = schema
+        self._values = values
+
+    def _diff(self, d):
+        """ Compare update with previous values using learned schema. """
+        values = self._values
+        update = {}
+        i = 0
+        for path, size, leaves in self._schema:
+            node = d
+            for key in path:
+                node = node[key]
+            if len(node) != size:
+                raise StructureChanged()
+
+            changed = None
+            for key in leaves:
+                value = node[key]
+                previous = values[i]
+                cls = value.__class__
+                if value is previous:
+                    i += 1
+                    continue
+                elif cls is float:
+                    if value != value or value == INF or value == -INF:
+                        value = None
+                        node[key] = None
+                    same = (value == previous)
+                elif cls is list or cls is tuple:
+                    # Arrays of different length differ without looking at
+                    # elements, otherwise comparison stops at first difference
+                    same = (previous.__class__ is cls and len(value) == len(previous) and value == previous)
+                else:
+                    same = (value == previous)
+                if not same:
+                    if isinstance(value, dict):
+                        raise StructureChanged()
+                    values[i] = value
+                    if changed is None:
+                        changed = update
+                        for k in path:
+                            changed = changed.setdefault(k, {})
+                    changed[key] = value
+                i += 1
+
+        return update
+
+def sanitizeDict(d):
+    """ Make all values in d and its sub-dictionaries JSON compliant, return d. """
+    nodes = [ d ]
+    while nodes:
+        node = nodes.pop()
+        for key, value in node.iteritems():
+            if isinstance(value, dict):
+                nodes.append(value)
+            else:
+                node[key] = sanitize(value)
+    return d
+
+def sanitize(value):
+    """ Return JSON compliant value, NaN, +Inf and -Inf are turned into None. """
+    if isinstance(value, float) and (value != value or value == INF or value == -INF):
+        return None
+    return value
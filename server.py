@@ -13,9 +13,13 @@ import argparse
 import logging
 import sys
 
+import backend
 import config
+import gateway
+import timing
 from common import WebEpicsError, WebEpicsWarning
 from convert import ConvertHandler
+from metrics import MetricsHandler
 from websocket import WebSocketHandler
 
 
@@ -34,13 +38,27 @@ if __name__ == "__main__":
         logging.critical(str(e))
         sys.exit(1)
 
+    # Gateway must be forked before any IOLoop is created
+    if cfg["gateway"]["enabled"] and cfg["gateway"]["spawn"]:
+        gateway.spawn(cfg)
+
     # Create single context - instantiate FileLoader, Cache etc.
     convert_ctx = ConvertHandler.createContext(cfg["convert"], "ws://<hostname>/ws")
 
+    # With gateway only the gateway process opens channels, factory is set after fork
+    ws_ctx = WebSocketHandler.createContext(cfg["websocket"])
+    if not cfg["gateway"]["enabled"]:
+        try:
+            ws_ctx["channel_factory"] = backend.createChannelFactory(cfg["backend"])
+        except WebEpicsError, e:
+            logging.critical(str(e))
+            sys.exit(1)
+
     settings = cfg["tornado"]
     handlers = [
-        (r"/ws", WebSocketHandler), # , {"websocket_max_message_size": 4096, "websocket_ping_interval": 30 }),
+        (r"/ws", WebSocketHandler, dict(ctx=ws_ctx)), # , {"websocket_max_message_size": 4096, "websocket_ping_interval": 30 }),
         (r"/static/(.*)", tornado.web.StaticFileHandler, cfg["static_web"]),
+        (r"/metrics", MetricsHandler),
         (r"/.*", ConvertHandler, dict(ctx=convert_ctx))
     ]
     # Put redirects at the front
@@ -52,4 +70,18 @@ if __name__ == "__main__":
     server = tornado.httpserver.HTTPServer(app)
     server.bind(cfg["server"]["port"])
     server.start(cfg["server"]["threads"])
+
+    # Conversion workers are forked before this process starts any threads
+    ConvertHandler.startWorkers(convert_ctx)
+
+    # kill -USR1 writes timing histograms of this process to log
+    timing.installSignalHandler()
+
+    # Each web server process watches files on its own
+    ConvertHandler.watchFiles(convert_ctx)
+
+    # Each web server process gets its own connection to the gateway
+    if cfg["gateway"]["enabled"]:
+        ws_ctx["channel_factory"] = gateway.GatewayClient(cfg["gateway"]["socket"]).createChannel
+
     tornado.ioloop.IOLoop.current().start()
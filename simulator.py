@@ -0,0 +1,227 @@
+# simulator.py
+#
+# Copyright (c) 2017 Oak Ridge National Laboratory.
+# All rights reserved.
+# See file LICENSE that is included with this distribution.
+#
+# @author Klemen Vodopivec
+
+"""
+Simulated PVs backend for testing and benchmarking without IOCs.
+
+Every PV name is valid. Type, update rate and waveform size of each PV are
+taken from the first entry in 'pvs' configuration list whose 'match'
+regular expression is found in PV url, or from defaults otherwise:
+
+    "simulator": {
+        "type": "scalar",       # scalar, enum or waveform
+        "rate": 1.0,            # updates per second, 0 for static PV
+        "size": 1000,           # number of waveform elements
+        "pvs": [
+            { "match": "Wf", "type": "waveform", "rate": 10.0, "size": 4096 }
+        ]
+    }
+
+Scalar value is a 0-100 sawtooth that goes into MINOR alarm above 90, enum
+cycles through its choices and waveform is a moving sine wave. Values
+accept puts. Time stamp of each update is the time it was generated, which
+makes it useful for measuring end-to-end latency.
+
+Monitor callbacks are invoked from single simulator thread, just like
+pvaccess invokes them from its own threads.
+"""
+
+import heapq
+import itertools
+import math
+import re
+import threading
+import time
+
+from common import PvValue
+
+ENUM_CHOICES = [ "Off", "On", "Fault", "Standby" ]
+
+class SimulatedChannel():
+    """ Channel of simulated PV, follows pvaccess.Channel interface. """
+
+    def __init__(self, simulator, pvurl, params):
+        self._simulator = simulator
+        self._pvurl = pvurl
+        self._type = params["type"]
+        self._rate = float(params["rate"])
+        self._size = int(params["size"])
+        self._callback = None
+        self._fields = None
+        self._lock = threading.Lock()
+
+        # Monitor is active while generation matches the one in scheduled entry
+        self._generation = 0
+        self._monitoring = False
+
+        self._counter = 0
+        if self._type == "enum":
+            self._value = 0
+        elif self._type == "waveform":
+            wave = [ round(50.0 + 50.0 * math.sin(2 * math.pi * i / self._size), 3) for i in range(self._size) ]
+            self._wave = wave + wave
+            self._value = None
+        else:
+            self._value = 0.0
+
+    def subscribe(self, name, callback):
+        self._callback = callback
+
+    def unsubscribe(self, name):
+        self._callback = None
+
+    def startMonitor(self, request="field()"):
+        fields = request.strip()[len("field("):-1]
+        self._fields = set(f.split(".")[0] for f in fields.split(",")) if fields else None
+        with self._lock:
+            self._generation += 1
+            self._monitoring = True
+            generation = self._generation
+        # Like pvaccess, first update is sent right away
+        self._simulator.schedule(self, time.time(), generation, self._rate > 0)
+
+    def stopMonitor(self):
+        with self._lock:
+            self._generation += 1
+            self._monitoring = False
+
+    def setTimeout(self, timeout):
+        pass
+
+    def get(self):
+        with self._lock:
+            return PvValue(self._generate())
+
+    def put(self, value):
+        with self._lock:
+            if self._type == "enum":
+                if value in ENUM_CHOICES:
+                    self._value = ENUM_CHOICES.index(value)
+                else:
+                    self._value = int(value) % len(ENUM_CHOICES)
+            elif self._type == "waveform":
+                self._value = [ float(v) for v in value ]
+            else:
+                self._value = float(value)
+            monitoring = self._monitoring
+            generation = self._generation
+        if monitoring:
+            self._simulator.schedule(self, time.time(), generation, False)
+
+    def tick(self, generation, advance):
+        """ Called from simulator thread, returns False when monitor is no longer active. """
+        with self._lock:
+            if generation != self._generation:
+                return False
+            if advance:
+                self._advance()
+            d = self._generate()
+            callback = self._callback
+
+        if self._fields is not None:
+            d = dict((k, v) for k, v in d.iteritems() if k in self._fields)
+        if callback is not None:
+            callback(PvValue(d))
+        return True
+
+    def _advance(self):
+        """ Move value to the next simulated step. """
+        self._counter += 1
+        if self._type == "enum":
+            self._value = (self._value + 1) % len(ENUM_CHOICES)
+        elif self._type == "waveform":
+            # Puts override waveform until next step
+            self._value = None
+        else:
+            self._value = round((self._value + 0.1) % 100.0, 1)
+
+    def _generate(self):
+        """ Return new dictionary with current PV structure. """
+        now = time.time()
+        d = {
+            "timeStamp": { "secondsPastEpoch": int(now), "nanoseconds": int((now % 1) * 1e9), "userTag": 0 },
+            "alarm": { "severity": 0, "status": 0, "message": "NO_ALARM" }
+        }
+        if self._type == "enum":
+            d["value"] = { "index": self._value, "choices": list(ENUM_CHOICES) }
+        else:
+            if self._type == "waveform":
+                if self._value is None:
+                    offset = self._counter % self._size
+                    d["value"] = self._wave[offset:offset + self._size]
+                else:
+                    d["value"] = list(self._value)
+            else:
+                d["value"] = self._value
+                if self._value > 90.0:
+                    d["alarm"] = { "severity": 1, "status": 1, "message": "HIGH" }
+            d["display"] = {
+                "limitLow": 0.0,
+                "limitHigh": 100.0,
+                "description": "Simulated " + self._type,
+                "units": "mA",
+                "precision": 1
+            }
+        return d
+
+class Simulator():
+    """ Creates simulated channels and drives their monitors.
+
+    All monitors are scheduled in a single heap sorted by time of next
+    update and served by one thread, started when first monitor starts.
+    """
+
+    def __init__(self, cfg):
+        self._defaults = {
+            "type": cfg.get("type", "scalar"),
+            "rate": cfg.get("rate", 1.0),
+            "size": cfg.get("size", 1000)
+        }
+        self._pvs = [ (re.compile(entry["match"]), entry) for entry in cfg.get("pvs", []) ]
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._thread = None
+
+    def createChannel(self, pvurl):
+        """ Channel factory, see backend module. """
+        params = dict(self._defaults)
+        for regex, entry in self._pvs:
+            if regex.search(pvurl):
+                params.update((k, v) for k, v in entry.iteritems() if k in params)
+                break
+        return SimulatedChannel(self, pvurl, params)
+
+    def schedule(self, channel, due, generation, repeat):
+        """ Schedule channel update at due time. """
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), channel, generation, repeat))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="simulator")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                due, _, channel, generation, repeat = heapq.heappop(self._heap)
+
+            if not channel.tick(generation, repeat) or not repeat:
+                continue
+
+            # Don't try to catch up when falling behind, just skip updates
+            due += 1.0 / channel._rate
+            if due < now:
+                due = now
+            self.schedule(channel, due, generation, True)
@@ -8,9 +8,25 @@ $(document).ready(function() {
     processOnDisconnect();
 
     var cachedPVs = {};
+
+    // Session token and sequence number of the last update received for
+    // each PV, used to resume subscriptions after reconnect
+    var session = null;
+    var pvSeqs = {};
+
     if (typeof(ws_url) !== "undefined") {
         if (typeof(debug) !== "boolean")
             debug = false;
+        // Ask server to pack updates into fewer frames, opt-in
+        if (typeof(multiplex) !== "boolean")
+            multiplex = false;
+        if (multiplex)
+            ws_url += (ws_url.indexOf("?") == -1 ? "?" : "&") + "multiplex=1";
+        // Ask server to send numeric arrays as binary typed arrays, opt-in
+        if (typeof(binary) !== "boolean")
+            binary = false;
+        if (binary)
+            ws_url += (ws_url.indexOf("?") == -1 ? "?" : "&") + "binary=1";
         createWebSocket(ws_url, 1000, debug);
     }
 
@@ -22,8 +38,9 @@ $(document).ready(function() {
      * Create WebSocket connection handle and initiate connect.
      * If connection to the server fails it automatically retries
      * until connected.
-     * When connection is established, processOnConnect() function
-     * is invoked.
+     * When connection is established, client asks to resume previous
+     * session. processOnConnect() function is invoked when server
+     * doesn't know the session any more.
      * Received messages are validated to be JSON and then passed
      * to processing function.
      * If connection is closed for whatever reason, reconnect is
@@ -31,12 +48,18 @@ $(document).ready(function() {
      */
     function createWebSocket(ws_url, connect_delay=1000, debug=false) {
         wsHandle = new WebSocket(ws_url);
+        wsHandle.binaryType = "arraybuffer";
         connected = false;
 
         wsHandle.onopen = function() {
             connected = true;
             console.log('Connected to WebSocket server ' + ws_url);
-            processOnConnect();
+            var req = { req: "session" };
+            if (session !== null) {
+                req.session = session;
+                req.acks = pvSeqs;
+            }
+            wsHandle.send(JSON.stringify(req));
         };
         wsHandle.onclose = function() {
             console.log('Closed WebSocket connection');
@@ -52,14 +75,44 @@ $(document).ready(function() {
             if (connected) console.log('WebSocket connection error:' + error);
         };
         wsHandle.onmessage = function(event) {
-            if (debug) console.log('Received an update from WebSocket ' + event.data);
-
-            var message = jQuery.parseJSON(event.data);
+            var message;
+            if (event.data instanceof ArrayBuffer) {
+                if (debug) console.log('Received binary update from WebSocket, ' + event.data.byteLength + ' bytes');
+                message = decodeBinaryFrame(event.data);
+            } else {
+                if (debug) console.log('Received an update from WebSocket ' + event.data);
+                message = jQuery.parseJSON(event.data);
+            }
             if ("rsp" in message) {
                 switch (message.rsp) {
+                    case "session":
+                        if (!message.resumed) {
+                            pvSeqs = {};
+                            processOnConnect();
+                        } else {
+                            if (debug) console.log("Resumed session " + message.session);
+                            // Server only sends what changed while disconnected,
+                            // repaint the rest that processOnDisconnect() greyed out
+                            for (var pv in cachedPVs)
+                                renderPv(cachedPVs[pv]);
+                        }
+                        session = message.session;
+                        break;
                     case "pv_update":
                         processPvUpdate(message);
                         break;
+                    case "pv_updates":
+                        for (var i=0; i<message.updates.length; i++) {
+                            processPvUpdate(message.updates[i]);
+                        }
+                        break;
+                    case "pv_put":
+                        if (message.status !== "success")
+                            console.log("Failed to write " + message.pv + ": " + message.status);
+                        break;
+                    case "pv_get":
+                        console.log("Failed to read " + message.pv + ": " + message.status);
+                        break;
                     default:
                         // Ignoring unknown response
                         break;
@@ -68,6 +121,34 @@ $(document).ready(function() {
         };
     }
 
+    /**
+     * Decode binary frame into response message.
+     * Frame starts with 32-bit little-endian length of JSON header, followed
+     * by the header and raw typed arrays. Header field 'binary' describes
+     * where each array starts and to which message field it belongs.
+     */
+    function decodeBinaryFrame(buffer) {
+        var types = { "int32": Int32Array, "float64": Float64Array };
+        var length = new DataView(buffer).getUint32(0, true);
+        // Header is pure ASCII JSON
+        var message = JSON.parse(String.fromCharCode.apply(null, new Uint8Array(buffer, 4, length)));
+        var start = 4 + length;
+
+        for (var i=0; i<message.binary.length; i++) {
+            var desc = message.binary[i];
+            var fields = desc.field.split(".");
+            var obj = message;
+            for (var j=0; j<fields.length-1; j++) {
+                if (!(fields[j] in obj))
+                    obj[fields[j]] = {};
+                obj = obj[fields[j]];
+            }
+            obj[fields[fields.length-1]] = new types[desc.type](buffer, start + desc.offset, desc.length);
+        }
+        delete message.binary;
+        return message;
+    }
+
     /* Return selected attribute value from response message. */
     function getAttrValue(attr, msg) {
         var value = msg;
@@ -81,7 +162,35 @@ $(document).ready(function() {
         return value;
     }
 
+    /**
+     * Return list of PV fields used by widget mappings of element, or null
+     * when all fields are needed.
+     */
+    function getPvFields(element) {
+        var re = /%([^%]*)%/g, match;
+        var fields = [ "value", "alarm" ];
+        var mapped = element.find("*[data-map]").addBack("[data-map]");
+        if (mapped.length == 0)
+            return null;
+
+        mapped.each(function() {
+            var map = $(this).data("map");
+            while (match = re.exec(map)) {
+                var field = match[1];
+                if (!/^[A-Za-z_][A-Za-z0-9_.]*$/.test(field))
+                    continue;
+                if (field == "valueNum" || field.split(".")[0] == "valueEnum")
+                    field = "value";
+                if (fields.indexOf(field) == -1)
+                    fields.push(field);
+            }
+        });
+        return fields.sort();
+    }
+
     function processOnConnect() {
+        // Combine requirements of all widgets using the same PV
+        var pvs = {};
         $("[data-pv!=''][data-pv]").each(function() {
             var pv = $(this).data("pv");
 
@@ -89,13 +198,69 @@ $(document).ready(function() {
             if (pv.split("://").length == 1)
                 pv = "ca://" + pv;
 
-            var req = {
-                pv: pv,
-                req: "pv_subscribe"
-            };
+            // Optional maximum number of updates per second
+            var rate_limit = $(this).data("rate-limit");
+            if (rate_limit === undefined)
+                rate_limit = 0;
+
+            // Only request fields referenced by widget mappings
+            var fields = getPvFields($(this));
+
+            // Optional value deadband, absolute or relative with % sign
+            var deadband = $(this).attr("data-deadband");
+            if (deadband === undefined)
+                deadband = null;
+
+            if (!(pv in pvs)) {
+                pvs[pv] = { rate_limit: rate_limit, fields: fields, deadband: deadband };
+            } else {
+                // Smallest deadband wins, can't compare absolute and relative
+                if (pvs[pv].deadband !== null && deadband !== null &&
+                    pvs[pv].deadband.endsWith("%") == deadband.endsWith("%")) {
+                    if (parseFloat(deadband) < parseFloat(pvs[pv].deadband))
+                        pvs[pv].deadband = deadband;
+                } else {
+                    pvs[pv].deadband = null;
+                }
+                if (pvs[pv].rate_limit > 0)
+                    pvs[pv].rate_limit = (rate_limit == 0 ? 0 : Math.max(rate_limit, pvs[pv].rate_limit));
+                if (pvs[pv].fields !== null && fields !== null) {
+                    for (var i=0; i<fields.length; i++) {
+                        if (pvs[pv].fields.indexOf(fields[i]) == -1)
+                            pvs[pv].fields.push(fields[i]);
+                    }
+                    pvs[pv].fields.sort();
+                } else {
+                    pvs[pv].fields = null;
+                }
+            }
+        });
+
+        // Subscribe to all PVs with as few requests as possible, one
+        // request for every distinct rate limit, fields and deadband combination
+        var requests = {};
+        for (var pv in pvs) {
+            var key = pvs[pv].rate_limit + "|" + (pvs[pv].fields === null ? "" : pvs[pv].fields.join(",")) + "|" + pvs[pv].deadband;
+            if (!(key in requests)) {
+                requests[key] = {
+                    pvs: [],
+                    req: "pv_subscribe"
+                };
+                if (pvs[pv].rate_limit > 0)
+                    requests[key].rate_limit = pvs[pv].rate_limit;
+                if (pvs[pv].fields !== null)
+                    requests[key].fields = pvs[pv].fields;
+                if (pvs[pv].deadband !== null)
+                    requests[key].deadband = pvs[pv].deadband;
+            }
+            requests[key].pvs.push(pv);
+        }
+
+        for (var key in requests) {
+            var req = requests[key];
             wsHandle.send(JSON.stringify(req));
             if (debug) console.log("Sent: " + JSON.stringify(req));
-        });
+        }
     }
 
     function processOnDisconnect() {
@@ -107,13 +272,23 @@ $(document).ready(function() {
     }
 
     function processPvUpdate(rsp) {
+        if ("seq" in rsp) {
+            pvSeqs[rsp.pv] = rsp.seq;
+            delete rsp.seq;
+        }
         if (rsp.pv in cachedPVs) {
             $.extend(cachedPVs[rsp.pv], rsp);
             rsp = cachedPVs[rsp.pv];
         } else {
             cachedPVs[rsp.pv] = rsp;
         }
+        renderPv(rsp);
+    }
 
+    /**
+     * Apply full cached PV structure to all widgets using the PV.
+     */
+    function renderPv(rsp) {
         // Enum hack, provide a combined numeric field. If enum field is detected,
         // use it's index, otherwise match the value.
         if ("valueEnum" in rsp) {
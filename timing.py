@@ -0,0 +1,94 @@
+# timing.py
+#
+# Copyright (c) 2017 Oak Ridge National Laboratory.
+# All rights reserved.
+# See file LICENSE that is included with this distribution.
+#
+# @author Klemen Vodopivec
+
+"""
+Fixed-bucket timing histograms for hot code paths.
+
+Code being measured takes time.time() before and after each stage and
+passes the difference to Histogram.observe(), which only finds the bucket
+and increments few numbers. Histograms are exported by /metrics and can be
+written to log any time by sending SIGUSR1 to web server process.
+
+Histograms are not protected by a lock, stages measured in pvaccess threads
+may very rarely lose an observation which is fine for statistics.
+"""
+
+import bisect
+import collections
+import logging
+import signal
+
+import tornado.ioloop
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of buckets in seconds, last bucket catches everything else
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+           0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# All histograms by name, in order of creation
+histograms = collections.OrderedDict()
+
+class Histogram():
+    """ Distribution of durations of single stage. """
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """ Account single duration. """
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def getPercentile(self, percent):
+        """ Return upper bound of bucket where given percentile falls in, but no more than max. """
+        target = self.count * percent / 100.0
+        total = 0
+        for i, n in enumerate(self.counts):
+            total += n
+            if total >= target and total > 0:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return 0.0
+
+def getHistogram(name, help=""):
+    """ Return histogram with given name, create one when it doesn't exist yet. """
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = Histogram(name, help)
+        histograms[name] = histogram
+    return histogram
+
+def dump():
+    """ Return human readable summary of all histograms. """
+    lines = [ "{0:<20} {1:>10} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}".format(
+              "stage", "count", "mean [us]", "p50 [us]", "p90 [us]", "p99 [us]", "max [us]") ]
+    for name, h in histograms.iteritems():
+        mean = h.sum / h.count if h.count > 0 else 0.0
+        lines.append("{0:<20} {1:>10} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>10.1f} {6:>10.1f}".format(
+            name, h.count, mean * 1e6, h.getPercentile(50) * 1e6, h.getPercentile(90) * 1e6,
+            h.getPercentile(99) * 1e6, h.max * 1e6))
+    return "\n".join(lines)
+
+def installSignalHandler(signum=signal.SIGUSR1):
+    """ Write histograms to log when process receives signal. """
+    ioloop = tornado.ioloop.IOLoop.current()
+    def logDump():
+        log.info("Timing histograms:\n" + dump())
+    signal.signal(signum, lambda signum, frame: ioloop.add_callback_from_signal(logDump))
@@ -0,0 +1,177 @@
+# watcher.py
+#
+# Copyright (c) 2017 Oak Ridge National Laboratory.
+# All rights reserved.
+# See file LICENSE that is included with this distribution.
+#
+# @author Klemen Vodopivec
+
+"""
+Watching directory tree for changed files using Linux inotify.
+
+Uses inotify system calls from libc through ctypes, no extra modules are
+needed. Events are read in IOLoop when inotify file descriptor becomes
+readable, so watcher needs to be created in the process that uses it,
+after the web server processes are forked.
+
+Callback gets path of changed file relative to watched directory, or None
+when changes can not be tracked precisely any more (ie. event queue
+overflow or directory moved) and anything may have changed. When watched
+directory itself is moved or deleted, watcher stops after calling back
+with None, since whatever takes its place is not watched.
+
+Watched directory can not be a symbolic link, switching the link to
+another directory would go unnoticed. Symbolic links in parent
+directories are resolved.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+
+import tornado.ioloop
+
+log = logging.getLogger(__name__)
+
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = 0x00080000
+
+# File is reported when it's done being written, renamed or deleted
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    _libc.inotify_init1.argtypes = [ ctypes.c_int ]
+    _libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+    _libc.inotify_rm_watch.argtypes = [ ctypes.c_int, ctypes.c_int ]
+except (OSError, AttributeError):
+    _libc = None
+
+class Watcher():
+    """ Watches all files in directory tree, including sub-directories created later. """
+
+    def __init__(self, path, callback):
+        """ Start watching path, raise OSError when not possible. """
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify not available")
+        if os.path.islink(os.path.normpath(path)):
+            raise OSError(errno.EINVAL, "{0} is a symbolic link".format(path))
+
+        self._root = os.path.realpath(path)
+        self._callback = callback
+        self._dirs = {}
+        self._ioloop = tornado.ioloop.IOLoop.current()
+
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        try:
+            self._addTree("")
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._ioloop.add_handler(self._fd, self._onEvents, tornado.ioloop.IOLoop.READ)
+        log.info("Watching {0} directories in {1}".format(len(self._dirs), self._root))
+
+    def isActive(self):
+        """ Return True while watcher is tracking changes. """
+        return self._fd is not None
+
+    def close(self):
+        """ Stop watching. """
+        if self._fd is not None:
+            self._ioloop.remove_handler(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            self._dirs = {}
+
+    def _addTree(self, reldir):
+        """ Add watches for directory and all its sub-directories, raise OSError on failure. """
+        for dirpath, _, _ in os.walk(os.path.join(self._root, reldir)):
+            wd = _libc.inotify_add_watch(self._fd, dirpath, WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, "Failed to watch {0}: {1}".format(dirpath, os.strerror(err)))
+            path = os.path.relpath(dirpath, self._root)
+            self._dirs[wd] = path if path != os.curdir else ""
+
+    def _removeTree(self, reldir):
+        """ Remove watches for directory that moved away and all its sub-directories. """
+        for wd, path in self._dirs.items():
+            if path == reldir or path.startswith(reldir + os.sep):
+                _libc.inotify_rm_watch(self._fd, wd)
+                del self._dirs[wd]
+
+    def _onEvents(self, fd, events):
+        """ Read and dispatch all pending events, called from IOLoop. """
+        try:
+            data = os.read(fd, 64 * 1024)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        changed = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip("\0")
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                log.warn("Too many file changes, some were missed")
+                changed.add(None)
+                continue
+            reldir = self._dirs.get(wd)
+            if reldir == "" and mask & (IN_MOVE_SELF | IN_DELETE_SELF | IN_IGNORED):
+                log.warn("{0} moved or deleted, no longer watching files".format(self._root))
+                self.close()
+                self._callback(None)
+                return
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if reldir is None or not name:
+                continue
+            path = os.path.join(reldir, name)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._addTree(path)
+                    except OSError, e:
+                        log.error("{0}, no longer watching files".format(str(e)))
+                        self.close()
+                        self._callback(None)
+                        return
+                if mask & IN_MOVED_FROM:
+                    self._removeTree(path)
+                # Files in the directory may have been cached
+                changed.add(None)
+            else:
+                changed.add(path)
+
+        # Report each file once, even if it got several events
+        if None in changed:
+            self._callback(None)
+        else:
+            for path in changed:
+                self._callback(path)
@@ -7,16 +7,27 @@
 # @author Klemen Vodopivec
 #
 
-import pvaccess
-
+import array
+import collections
+import concurrent.futures
+import datetime
+import itertools
 import json
 import logging
-import math
+import struct
+import sys
+import threading
+import time
+import uuid
 
 from common import WebEpicsError, WebEpicsWarning
+import backend
+import pvdiff
+import timing
 
+import tornado.escape
 import tornado.gen
-import tornado.locks
+import tornado.ioloop
 import tornado.websocket
 
 log = logging.getLogger(__name__)
@@ -25,144 +36,995 @@ log = logging.getLogger(__name__)
 # Same PVs can be used by different clients.
 pvs = {}
 
-class PV():
-    """ PV class manages connection to one PV. """
-    def __init__(self, pvurl):
+# Statistics of all WebSocket clients, degraded is number of clients
+# currently in latest-value-only mode
+clientStats = {
+    "degraded": 0,
+    "stalled_disconnects": 0,
+    "messages_sent": 0,
+    "bytes_sent": 0
+}
+
+# Currently connected WebSocket clients
+clients = set()
+
+# Statistics of PVs that were disconnected and removed from pvs dictionary,
+# statistics of PVs still in pvs need to be added to get totals
+retiredStats = {
+    "queued": 0,
+    "dropped": 0,
+    "updates": 0,
+    "process_seconds": 0.0
+}
+
+# Sequence numbers of PV updates, shared by all PVs so that numbers of
+# reconnected PV never repeat the ones clients received before
+updateSeq = itertools.count(1)
+
+# Timing of PV update processing stages
+toDictTiming = timing.getHistogram("pv_todict", "Converting monitor update to dictionary")
+enumTiming = timing.getHistogram("pv_enum", "Resolving enum value")
+diffTiming = timing.getHistogram("pv_diff", "Calculating changes from previous update")
+fanoutTiming = timing.getHistogram("pv_fanout", "Sending update to all subscribed clients")
+
+def mergeUpdate(dst, src):
+    """ Recursively merge PV update src into dst, values from src win.
+
+    Nested dictionaries from src are copied before merged so that src
+    (which is shared among all clients) is never modified.
+    """
+    for key, value in src.iteritems():
+        if isinstance(value, dict):
+            if not isinstance(dst.get(key), dict):
+                dst[key] = {}
+            mergeUpdate(dst[key], value)
+        else:
+            dst[key] = value
+    return dst
+
+def parseFields(fields):
+    """ Turn list of field names into sorted tuple of field paths.
+
+    Field names can address sub-fields using dot, ie. 'display.units'.
+    Fields already covered by their parent field are removed. Enum PVs
+    have their value moved to valueEnum, so it's included with value.
+    Returns None when fields is empty, meaning all fields.
+    """
+    if not fields:
+        return None
+
+    paths = set( tuple(str(field).split(".")) for field in fields )
+    if ("value",) in paths:
+        paths.add( ("valueEnum",) )
+    for path in list(paths):
+        for i in range(1, len(path)):
+            if path[:i] in paths:
+                paths.discard(path)
+                break
+    return tuple(sorted(paths))
+
+def parseDeadband(deadband):
+    """ Turn deadband field of subscribe request into (absolute, relative) tuple.
+
+    Deadband is a number for absolute deadband or a string with percent
+    sign for deadband relative to the last sent value, ie. 0.01 or "0.1%".
+    Returns None when no deadband or invalid.
+    """
+    if deadband is None:
+        return None
+    try:
+        if isinstance(deadband, basestring) and deadband.strip().endswith("%"):
+            deadband = (0.0, float(deadband.strip()[:-1]) / 100.0)
+        else:
+            deadband = (float(deadband), 0.0)
+    except ValueError:
+        return None
+    if deadband[0] < 0 or deadband[1] < 0 or deadband == (0.0, 0.0):
+        return None
+    return deadband
+
+def filterUpdate(update, fields):
+    """ Return new dictionary with only selected fields from update.
+
+    fields is a tuple of field paths as returned by parseFields(), or None
+    for all fields in which case update is returned as is.
+    """
+    if fields is None:
+        return update
+
+    d = {}
+    for path in fields:
+        src = update
+        for key in path[:-1]:
+            src = src.get(key)
+            if not isinstance(src, dict):
+                break
+        else:
+            if path[-1] in src:
+                dst = d
+                for key in path[:-1]:
+                    dst = dst.setdefault(key, {})
+                dst[path[-1]] = src[path[-1]]
+    return d
+
+def resolveEnum(d):
+    """ Enum workaround - rename existing value field to valueEnum,
+                          add value field with resolved string
+
+    This way client will get updated value and index, but can also get
+    choices the first time.
+    """
+    try:
+        # First extract value, can throw and skip the rest of code block
+        value = d["value"]["choices"][ d["value"]["index"] ]
+        d["valueEnum"] = d["value"]
+        d["value"] = value
+    except (KeyError, TypeError, IndexError):
+        # Not an enum, or monitored fields don't include value
+        pass
+
+def toTypedArray(values):
+    """ Turn list of numbers into array of 32-bit integers or 64-bit floats.
+
+    Returns tuple of JavaScript typed array name and little-endian array,
+    or None when list is not a homogeneous numeric list.
+    """
+    if not values or isinstance(values[0], bool):
+        return None
+
+    try:
+        if isinstance(values[0], (int, long)):
+            try:
+                typename, a = "int32", array.array("i", values)
+            except (TypeError, OverflowError):
+                typename, a = "float64", array.array("d", values)
+        elif isinstance(values[0], float):
+            typename, a = "float64", array.array("d", values)
+        else:
+            return None
+    except (TypeError, OverflowError):
+        return None
+
+    if sys.byteorder != "little":
+        a.byteswap()
+    return (typename, a)
+
+class EncodedUpdate():
+    """ PV update turned into pv_update frames.
+
+    Object is shared by all clients receiving the same update. Each encoding
+    is done on first request only, regardless of the number of clients.
+    Optional seq is PV update sequence number, see PV.getChangesSince().
+    """
+
+    def __init__(self, pvurl, update, seq=None):
         self._pvurl = pvurl
-        protocol, self._pvname = pvurl.split("://", 1)
-        if protocol == "pva":
-            self._protocol = pvaccess.PVA
-        elif protocol == "ca":
-            self._protocol = pvaccess.CA
+        self._update = update
+        self._seq = seq
+        self._json = None
+        self._binary = None
+
+    def getUpdate(self):
+        """ Return update dictionary as passed to constructor. """
+        return self._update
+
+    def getSeq(self):
+        """ Return sequence number of the update, or None. """
+        return self._seq
+
+    def getJson(self):
+        """ Return pv_update response encoded as JSON string. """
+        if self._json is None:
+            rsp = dict(self._update)
+            rsp["pv"] = self._pvurl
+            rsp["rsp"] = "pv_update"
+            if self._seq is not None:
+                rsp["seq"] = self._seq
+            self._json = tornado.escape.json_encode(rsp)
+        return self._json
+
+    def getBinary(self, min_size):
+        """ Return pv_update response encoded as binary frame, or None.
+
+        Numeric arrays with at least min_size elements are sent as raw
+        little-endian typed arrays, everything else in a JSON header.
+        Frame starts with 32-bit length of JSON header, followed by header
+        padded to 8 bytes and arrays, each starting at 8 bytes boundary.
+        Header 'binary' field describes arrays, their 'field' path, array
+        'type', 'length' in elements and 'offset' from the end of header.
+        None is returned when update doesn't have any suitable array, JSON
+        frame should be used instead.
+        """
+        if self._binary is None:
+            arrays = []
+            rsp = self._extractArrays(self._update, [], arrays, min_size)
+            if not arrays:
+                self._binary = False
+                return None
+
+            rsp["pv"] = self._pvurl
+            rsp["rsp"] = "pv_update"
+            if self._seq is not None:
+                rsp["seq"] = self._seq
+            rsp["binary"] = []
+            payload = []
+            offset = 0
+            for field, (typename, a) in arrays:
+                data = a.tostring()
+                rsp["binary"].append({ "field": field, "type": typename, "offset": offset, "length": len(a) })
+                payload.append(data)
+                offset += len(data)
+                if len(data) % 8 != 0:
+                    payload.append("\0" * (8 - len(data) % 8))
+                    offset += 8 - len(data) % 8
+
+            header = tornado.escape.json_encode(rsp)
+            header += " " * ((8 - (4 + len(header)) % 8) % 8)
+            self._binary = struct.pack("<I", len(header)) + header + "".join(payload)
+
+        return self._binary or None
+
+    def _extractArrays(self, src, path, arrays, min_size):
+        """ Return copy of src without numeric arrays, which are appended to arrays list. """
+        dst = {}
+        for key, value in src.iteritems():
+            if isinstance(value, dict):
+                dst[key] = self._extractArrays(value, path + [key], arrays, min_size)
+                continue
+            if isinstance(value, list) and len(value) >= min_size:
+                typed = toTypedArray(value)
+                if typed is not None:
+                    arrays.append( (".".join(path + [key]), typed) )
+                    continue
+            dst[key] = value
+        return dst
+
+class ExpiringLRU():
+    """ Entries that expire ttl seconds after they were put, oldest first.
+
+    Entries are kept in the order they were put, which is also the order
+    they expire in as long as all of them use the same ttl. Number of
+    entries is limited, oldest entries are evicted first. Removed values
+    are passed to onRemove callback when given and counted as 'evictions'
+    or 'expirations' in stats dictionary. With timer enabled, expired
+    entries are removed by IOLoop timer, otherwise when accessed.
+    """
+
+    def __init__(self, stats, onRemove=None, timer=False):
+        self.stats = stats
+        self._onRemove = onRemove
+        self._useTimer = timer
+        self._timer = None
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Return value or None when not found or expired. """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= tornado.ioloop.IOLoop.current().time():
+            del self._entries[key]
+            self._removed(entry[0], "expirations")
+            return None
+        return entry[0]
+
+    def pop(self, key):
+        """ Remove entry without calling onRemove, return its value or None when not found. """
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def put(self, key, value, ttl, size):
+        """ Put value as the newest entry, evict oldest entries over size. """
+        ioloop = tornado.ioloop.IOLoop.current()
+        self._entries.pop(key, None)
+        self._entries[key] = (value, ioloop.time() + ttl)
+
+        while len(self._entries) > size:
+            _, (oldest, _) = self._entries.popitem(last=False)
+            self._removed(oldest, "evictions")
+
+        if self._useTimer and self._timer is None:
+            self._timer = ioloop.call_later(ttl, self._expire)
+
+    def _expire(self):
+        """ Remove expired entries and schedule next check. """
+        ioloop = tornado.ioloop.IOLoop.current()
+        self._timer = None
+
+        now = ioloop.time()
+        while self._entries:
+            key, (value, expires) = next(self._entries.iteritems())
+            if expires > now:
+                self._timer = ioloop.call_at(expires, self._expire)
+                break
+            del self._entries[key]
+            self._removed(value, "expirations")
+
+    def _removed(self, value, reason):
+        self.stats[reason] += 1
+        if self._onRemove is not None:
+            self._onRemove(value)
+
+class ChannelPool():
+    """ LRU pool of PVs without clients whose channels are kept open for a while.
+
+    When the last client unsubscribes from PV, its channel and monitor are
+    kept alive for linger seconds. Client subscribing in that period gets
+    full cached value right away without reconnecting to IOC. Pool is
+    limited in size, least recently released PVs are disconnected first.
+    """
+
+    def __init__(self, linger=10.0, size=1000):
+        self.linger = linger
+        self.size = size
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+        self._idle = ExpiringLRU(self.stats, self._disconnect, timer=True)
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self, pv, connected):
+        """ Called when PV gets its first client, removes PV from the pool. """
+        if self._idle.pop(pv.getUrl()) is not None and connected:
+            self.stats["hits"] += 1
         else:
+            self.stats["misses"] += 1
+
+    def release(self, pv):
+        """ Called when PV loses its last client, puts PV in the pool. """
+        if self.linger <= 0 or self.size <= 0:
+            self._disconnect(pv)
+            return
+        self._idle.put(pv.getUrl(), pv, self.linger, self.size)
+
+    def _disconnect(self, pv):
+        """ Close PV channel and forget about PV object. """
+        pv.disconnect()
+        if pvs.get(pv.getUrl()) is pv:
+            del pvs[pv.getUrl()]
+            for key in retiredStats:
+                retiredStats[key] += pv.stats[key]
+
+# Pool of idle PVs, configured by WebSocketHandler.createContext()
+pool = ChannelPool()
+
+class SessionStore():
+    """ Subscriptions of disconnected clients kept for a while.
+
+    Client that starts a session gets a token. When its connection drops,
+    its subscriptions are parked under the token for grace seconds. Client
+    reconnecting with the token in that period gets its subscriptions back
+    without subscribing again, see WebSocketHandler._reqSession(). Store is
+    limited in size, oldest parked sessions are dropped first.
+
+    Clients need to provide getSubscriptions() and close() methods.
+    """
+
+    def __init__(self, grace=30.0, size=10000):
+        self.grace = grace
+        self.size = size
+        self._attached = {}
+        self.stats = {
+            "created": 0,
+            "resumed": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+        self._detached = ExpiringLRU(self.stats, timer=True)
+
+    def __len__(self):
+        return len(self._detached)
+
+    def create(self, client):
+        """ Start new session of connected client, return its token. """
+        token = uuid.uuid4().hex
+        self._attached[token] = client
+        self.stats["created"] += 1
+        return token
+
+    def resume(self, token, client):
+        """ Attach client to existing session, return its subscriptions or None when not known. """
+        subscriptions = self._detached.pop(token)
+        if subscriptions is None:
+            # Client may reconnect before its old connection is detected
+            # as closed, in which case the new connection takes over
+            old = self._attached.get(token)
+            if old is None or old is client:
+                return None
+            subscriptions = old.getSubscriptions()
+            old.close()
+
+        self._attached[token] = client
+        self.stats["resumed"] += 1
+        return subscriptions
+
+    def detach(self, token, client, subscriptions):
+        """ Called when client disconnects, parks its subscriptions. """
+        if self._attached.get(token) is not client:
+            # Taken over by another connection
+            return
+        del self._attached[token]
+
+        if self.grace <= 0 or self.size <= 0:
+            return
+        self._detached.put(token, subscriptions, self.grace, self.size)
+
+# Sessions of all clients, configured by WebSocketHandler.createContext()
+sessions = SessionStore()
+
+class PV():
+    """ PV class manages connection to one PV.
+
+    Monitor callbacks are invoked from backend threads. They only queue
+    received updates, all processing and sending to clients is done in
+    IOLoop thread where PV object was created.
+    """
+    def __init__(self, pvurl, queue_size=16, channelFactory=None, history_size=0, deadband_hold=1.0):
+        self._pvurl = pvurl
+        protocol, pvname = pvurl.split("://", 1)
+        if protocol not in ("pva", "ca"):
             raise TypeError("Unsupported protocol {0}".format(protocol))
 
-        if len(self._pvname) == 0:
+        if len(pvname) == 0:
             raise TypeError("Empty PV string")
 
+        # Channel objects are created by backend channel factory taking PV url,
+        # see backend module for channel interface
+        self._channelFactory = channelFactory or backend.createPvaccessChannel
         self._ch = None
-        self._clients = []
+
+        # Channel for get and put while there's no monitor, created in
+        # executor thread and kept until disconnect(), see _getChannel()
+        self._requestCh = None
+        self._requestChLock = threading.Lock()
         self._cached = {}
+        self._diff = pvdiff.DiffEngine()
 
-    def subscribe(self, client):
-        """ Subscribes WebSocket client to receive this PV's updates. """
-        if client not in self._clients:
-            self._clients.append(client)
-            #log.info("Subscribed client: {0}".format(client.getClientId()))
+        # Subscribed clients in order of subscription, mapped to fields each
+        # of them requested. The union of all fields is requested from the
+        # monitor, None means all fields. Popular PVs can have thousands of
+        # clients, adding and removing one must not depend on their number.
+        self._clients = collections.OrderedDict()
+        self._monitorFields = None
+
+        # Deadband state of clients that requested one, see _applyDeadband()
+        self._deadbands = {}
+        self._deadbandHold = deadband_hold
+
+        # Sequence number of the last update and a history of recent
+        # changes, see getChangesSince()
+        self._seq = None
+        self._history = collections.deque(maxlen=max(0, history_size))
+        self._historyBase = None
+
+        # Bounded queue of received updates not yet processed, when full
+        # oldest updates are dropped. Since every update contains complete
+        # PV structure, dropping one only loses intermediate values.
+        self._ioloop = tornado.ioloop.IOLoop.current()
+        self._queue = collections.deque(maxlen=max(1, queue_size))
+        self._queueLock = threading.Lock()
+        self._queueScheduled = False
+        self.stats = {
+            "queued": 0,
+            "dropped": 0,
+            "updates": 0,
+            "process_seconds": 0.0
+        }
+
+    def getUrl(self):
+        """ Return PV url as passed to constructor. """
+        return self._pvurl
+
+    def getCached(self):
+        """ Return last received full PV structure, empty when not connected. """
+        return self._cached
+
+    def getSeq(self):
+        """ Return sequence number of the last update, None when there was none yet. """
+        return self._seq
+
+    def getChangesSince(self, seq):
+        """ Return all changes since update with sequence number seq, merged into single update.
+
+        Returns None when changes are not known any more, because they are
+        older than kept in history or PV has reconnected since. Empty
+        dictionary means nothing has changed.
+        """
+        if self._historyBase is None or seq < self._historyBase or seq > self._seq:
+            return None
+        update = {}
+        for s, changes in self._history:
+            if s > seq:
+                mergeUpdate(update, changes)
+        return update
+
+    def isMonitored(self, fields=None):
+        """ Return True when active monitor receives all fields, see parseFields(). """
+        if self._ch is None:
+            return False
+        if self._monitorFields is None:
+            return True
+        if fields is None:
+            return False
+        monitored = set(self._monitorFields)
+        for path in fields:
+            if not any(path[:i] in monitored for i in range(1, len(path) + 1)):
+                return False
+        return True
+
+    def getClientCount(self):
+        """ Return number of subscribed clients. """
+        return len(self._clients)
+
+    def subscribe(self, client, fields=None, deadband=None, seq=None):
+        """ Subscribes WebSocket client to receive this PV's updates.
+
+        fields is a tuple of field paths client is interested in, as
+        returned by parseFields(), None for all fields. Monitor is
+        restarted when client requests fields not yet monitored.
+        deadband is (absolute, relative) tuple as returned by
+        parseDeadband(), value changes within deadband are not sent to
+        client. Client normally receives full cached PV structure right
+        away, client that already received update with sequence number seq
+        only gets the changes since, see getChangesSince().
+        """
+        if not self._clients:
+            pool.acquire(self, self._ch is not None)
+
+        # Resubscribing client only changes fields, not its position
+        self._clients[client] = fields
+        self._cancelDeadband(client)
+        if deadband is not None:
+            self._deadbands[client] = {
+                "absolute": deadband[0],
+                "relative": deadband[1],
+                "last": None,
+                "pending": None,
+                "timer": None
+            }
 
         if self._ch is None:
-            self._ch = pvaccess.Channel(self._pvname, self._protocol)
+            self._monitorFields = fields
+            with self._requestChLock:
+                self._ch, self._requestCh = self._requestCh, None
+            if self._ch is None:
+                self._ch = self._createChannel()
             self._ch.subscribe("webepics", self.updateCb)
-            self._ch.startMonitor("field()")
+            self._ch.startMonitor(self._getRequest())
+        elif self._monitorFields is not None and (fields is None or not set(fields).issubset(self._monitorFields)):
+            if fields is None:
+                self._monitorFields = None
+            else:
+                union = set(fields) | set(self._monitorFields)
+                self._monitorFields = parseFields([ ".".join(path) for path in union ])
+            log.debug("Restarting {0} monitor with {1}".format(self._pvurl, self._getRequest()))
+            self._ch.stopMonitor()
+            self._ch.startMonitor(self._getRequest())
 
         if self._cached:
             # Monitor is already active and it won't send full PV structure once it connects,
             # but the protocol requires client receives full update on connect so do it here
-            try:
-                self.sendToClients(self._cached, [client])
-            except tornado.websocket.WebSocketClosedError:
-                pass
+            update = None
+            if seq is not None:
+                update = self.getChangesSince(seq)
+            if update is None:
+                update = self._cached
+            if update:
+                try:
+                    self.sendToClients(update, [client])
+                except tornado.websocket.WebSocketClosedError:
+                    pass
 
     def unsubscribe(self, client):
         """ Unsubscribes clients from further receiving updates for this PV. """
-        try:
-            self._clients.remove(client)
-            log.info("Unsubscribed client: {0}".format(client.getClientId()))
-            if not self._clients:
-                self._ch.stopMonitor()
-                self._ch.unsubscribe("webepics")
-                self._ch = None
-                self._cached = {}
-                log.debug("No more clients, stopped monitor")
-            return True
-        except:
+        if client not in self._clients:
             return False
+        del self._clients[client]
+        self._cancelDeadband(client)
+
+        log.debug("Unsubscribed client: {0}".format(client.getClientId()))
+        if not self._clients:
+            # Keep channel open for a while in case client comes back
+            pool.release(self)
+        return True
+
+    def disconnect(self):
+        """ Stop monitor and close the channels. """
+        with self._requestChLock:
+            self._requestCh = None
+        if self._ch is not None:
+            self._ch.stopMonitor()
+            self._ch.unsubscribe("webepics")
+            self._ch = None
+            self._cached = {}
+            self._monitorFields = None
+            self._diff.reset()
+            self._history.clear()
+            self._historyBase = None
+            with self._queueLock:
+                self._queue.clear()
+            log.debug("No more clients, stopped monitor")
+
+    def _createChannel(self):
+        """ Return new channel object for this PV. """
+        return self._channelFactory(self._pvurl)
+
+    def _getChannel(self, timeout=None):
+        """ Return channel for get and put, called from executor thread.
+
+        Monitor channel is used when active, otherwise a channel is created
+        on first use and kept until disconnect(). Blocking calls on either
+        are limited to timeout seconds.
+        """
+        ch = self._ch
+        if ch is None:
+            with self._requestChLock:
+                if self._requestCh is None:
+                    self._requestCh = self._createChannel()
+                ch = self._requestCh
+        if timeout is not None:
+            ch.setTimeout(timeout)
+        return ch
 
-    def put(self, value):
-        """ Request a put command with a new value. """
+    def _getRequest(self):
+        """ Return pvRequest string for monitored fields. """
+        if self._monitorFields is None:
+            return "field()"
+        paths = [ path for path in self._monitorFields if path != ("valueEnum",) ]
+        return "field({0})".format(",".join(".".join(path) for path in paths))
 
-        ch = pvaccess.Channel(self._pvname, self._protocol)
-        ch.put(value)
+    def put(self, value, timeout=None):
+        """ Request a put command with a new value.
+
+        This is a blocking call and should be run in executor thread, limited
+        to timeout seconds. Channel of active monitor is reused, see
+        _getChannel().
+        """
+        self._getChannel(timeout).put(value)
+
+    def get(self, timeout=None):
+        """ Return current PV structure read with channel get.
+
+        This is a blocking call and should be run in executor thread, channel
+        is reused just like in put(). Returned dictionary has the same form
+        as the updates sent to clients.
+        """
+        d = self._getChannel(timeout).get().toDict()
+        resolveEnum(d)
+        return pvdiff.sanitizeDict(d)
 
     def sendToClients(self, message, clientList=[]):
         """ Send response message to clients in list or all subscribed clients if list is empty.
 
-        When a stalled or disconnected client is detected, it's automatically
-        deleted from subscribed list. message can be a JSON string or a
-        dictionary that will be turned to JSON string.
+        message is a dictionary which is filtered to fields each client
+        requested and turned into pv_update frames. Clients that fail to
+        send because their connection is closed are unsubscribed right away,
+        from other PVs when connection close is handled, see unsubscribeAll().
+        Clients may unsubscribe while sending, iteration is done over a copy.
+        Clients requesting the same fields share the same frames,
+        encoding is done only once. Clients with deadband may get their
+        own frames, see _applyDeadband().
         """
 
-        if not clientList:
-            clientList = self._clients
+        if clientList:
+            clientList = [ (client, self._clients.get(client)) for client in clientList ]
+        elif self._clients:
+            clientList = self._clients.items()
+        else:
+            return
+
+        encodedByFields = {}
+
+        for client, fields in clientList:
+            if client not in self._clients:
+                continue
+
+            encoded = encodedByFields.get(fields)
+            if encoded is None:
+                encoded = EncodedUpdate(self._pvurl, filterUpdate(message, fields), self._seq)
+                encodedByFields[fields] = encoded
+            update = encoded.getUpdate()
+
+            deadband = self._deadbands.get(client)
+            if deadband is not None and update:
+                update = self._applyDeadband(client, deadband, update)
+                if update is None:
+                    continue
+                if update is not encoded.getUpdate():
+                    encoded = EncodedUpdate(self._pvurl, update, self._seq)
+
+            if not update:
+                continue
 
-        closedClients = []
-        for client in clientList:
             try:
-                client.onPvUpdate(self._pvurl, message)
+                client.onPvUpdate(self._pvurl, update, encoded)
             except tornado.websocket.WebSocketClosedError:
-                log.debug("Removing disconnected client")
-                closedClients.append(client)
+                self.unsubscribe(client)
+
+    def _applyDeadband(self, client, deadband, update):
+        """ Return update to be sent to client with deadband, None to skip it.
+
+        Update is skipped when it only changes value within deadband from
+        the last value sent to client, and time stamp. Any other change,
+        like alarm severity, always goes through. Skipped updates are
+        merged into the next update sent so that client doesn't miss any
+        fields that changed in the meantime. Small changes may still change
+        what client shows, skipped updates are therefore sent on their own
+        after deadband_hold seconds, see _flushDeadband().
+        """
+        value = update.get("value")
+        last = deadband["last"]
+        if last is not None and set(update).issubset(("value", "timeStamp")):
+            if "value" not in update:
+                skip = True
+            elif isinstance(value, (int, long, float)):
+                skip = abs(value - last) < max(deadband["absolute"], deadband["relative"] * abs(last))
+            else:
+                skip = False
+
+            if skip:
+                deadband["pending"] = mergeUpdate(deadband["pending"] or {}, update)
+                if deadband["timer"] is None and self._deadbandHold > 0:
+                    deadband["timer"] = self._ioloop.call_later(self._deadbandHold, self._flushDeadband, client, deadband)
+                return None
+
+        if deadband["pending"] is not None:
+            update = mergeUpdate(deadband["pending"], update)
+            deadband["pending"] = None
+        if deadband["timer"] is not None:
+            self._ioloop.remove_timeout(deadband["timer"])
+            deadband["timer"] = None
 
-        for client in closedClients:
+        if "value" in update:
+            value = update["value"]
+            deadband["last"] = value if isinstance(value, (int, long, float)) else None
+        return update
+
+    def _flushDeadband(self, client, deadband):
+        """ Send update that deadband held back for deadband_hold seconds. """
+        deadband["timer"] = None
+        if self._deadbands.get(client) is not deadband or not deadband["pending"]:
+            return
+
+        update, deadband["pending"] = deadband["pending"], None
+        if "value" in update:
+            value = update["value"]
+            deadband["last"] = value if isinstance(value, (int, long, float)) else None
+        try:
+            client.onPvUpdate(self._pvurl, update, EncodedUpdate(self._pvurl, update, self._seq))
+        except tornado.websocket.WebSocketClosedError:
             self.unsubscribe(client)
 
+    def _cancelDeadband(self, client):
+        """ Forget deadband state of client. """
+        deadband = self._deadbands.pop(client, None)
+        if deadband is not None and deadband["timer"] is not None:
+            self._ioloop.remove_timeout(deadband["timer"])
+
     def updateCb(self, pv):
-        """ Callback function called when any PV field changes. """
+        """ Callback function called from backend thread when any PV field changes.
+
+        Only converts PV object to dictionary and queues it for processing in
+        IOLoop. When queue is full, the oldest update is dropped.
+        """
+        start = time.time()
         try:
             d = pv.toDict()
+        except Exception, e:
+            log.warn("Failed to parse PV update: {0}".format(str(e)))
+            return
+        toDictTiming.observe(time.time() - start)
 
-            # Enum workaround - rename existing value field to valueEnum,
-            #                   add value field with resolved string
-            # This way client will get updated value and index, but can also
-            # get choices the first time
-            try:
-                # First extract value, can throw and skip the rest of code block
-                value = d["value"]["choices"][ d["value"]["index"] ]
-                d["valueEnum"] = d["value"]
-                d["value"] = value
-            except TypeError:
-                pass
+        with self._queueLock:
+            if len(self._queue) == self._queue.maxlen:
+                self.stats["dropped"] += 1
+            self._queue.append(d)
+            self.stats["queued"] += 1
+
+            if self._queueScheduled:
+                return
+            self._queueScheduled = True
+
+        self._ioloop.add_callback(self._processQueue)
+
+    def _processQueue(self):
+        """ Process all queued updates, called from IOLoop. """
+        with self._queueLock:
+            updates = list(self._queue)
+            self._queue.clear()
+            self._queueScheduled = False
+
+        start = time.time()
+        for d in updates:
+            # Unsubscribed in the meantime
+            if self._ch is None:
+                break
+            self._processUpdate(d)
+        self.stats["process_seconds"] += time.time() - start
+
+    def _processUpdate(self, d):
+        """ Calculate changes from previous update and send them to clients. """
+        t0 = time.time()
+        try:
+            resolveEnum(d)
+            t1 = time.time()
+            enumTiming.observe(t1 - t0)
 
             # Calculate the differencies from previous update
-            update = self._calcPvDiff(self._cached, d)
-            update = self._jsonVerify(update)
+            update = self._diff.diff(d)
+            connected = bool(self._cached)
             self._cached = d
+            t0 = time.time()
+            diffTiming.observe(t0 - t1)
         except Exception, e:
             log.warn("Failed to parse PV update: {0}".format(str(e)))
             return
 
+        if not update:
+            return
+
+        self._seq = next(updateSeq)
+        if not connected or self._history.maxlen == 0:
+            # First update is full PV structure, changes before it don't matter
+            self._history.clear()
+            self._historyBase = self._seq
+        else:
+            if len(self._history) == self._history.maxlen:
+                self._historyBase = self._history[0][0]
+            self._history.append( (self._seq, update) )
+
+        self.stats["updates"] += 1
         try:
             self.sendToClients(update)
         except Exception, e:
             log.warn("Failed to send update to clients: {0}".format(str(e)))
             return
+        fanoutTiming.observe(time.time() - t0)
 
-    def _calcPvDiff(self, old, new, level=0):
-        """ Return a copy of new with missing keys filled in from old. """
-        d = {}
-        if level < 3:
-            for key in new.keys():
-                if key not in old:
-                    d[key] = new[key]
-                elif isinstance(new[key], dict):
-                    d1 = self._calcPvDiff(old[key], new[key], level+1)
-                    if d1:
-                        d[key] = d1
-                elif old[key] != new[key]:
-                    d[key] = new[key]
-        return d
-
-    def _jsonVerify(self, d):
-        """ Recursively checks and fixes dictionary to be JSON compliant.
-
-        NaN, +Inf, -Inf are turned into None.
-        """
-        for key in d.keys():
-            if isinstance(d[key], dict):
-                d[key] = self._jsonVerify(d[key])
-            elif isinstance(d[key], float) and (math.isnan(d[key]) or math.isinf(d[key])):
-                d[key] = None
-        return d
+def unsubscribeAll(client, pvList):
+    """ Unsubscribe disconnected client from all PVs in iterable.
+
+    Each unsubscribe takes constant time regardless of number of PV clients,
+    so that many clients disconnecting at once don't stall IOLoop.
+    """
+    count = 0
+    for pv in pvList:
+        if pv.unsubscribe(client):
+            count += 1
+    if count > 0:
+        log.info("Unsubscribed client {0} from {1} PVs".format(client.getClientId(), count))
+
+def createPV(ctx, pvurl):
+    """ Return new PV object configured from WebSocketHandler context. """
+    return PV(str(pvurl), ctx["queue_size"], ctx["channel_factory"], ctx["session_history"], ctx["deadband_hold"])
+
+def borrowPV(ctx, pvurl):
+    """ Return shared PV object for get or put, created and registered when needed.
+
+    PV must be given back with releasePV() once done.
+    """
+    pv = pvs.get(pvurl)
+    if pv is None:
+        pv = createPV(ctx, pvurl)
+        pvs[pvurl] = pv
+    return pv
+
+def releasePV(pv):
+    """ Keep borrowed PV without clients in the pool, so its channel is reused for a while. """
+    if pv.getClientCount() == 0:
+        pool.release(pv)
+
+@tornado.gen.coroutine
+def putValue(ctx, pvurl, value, timeout):
+    """ Put value to PV in executor thread, return status string once done.
+
+    Value cached for get is discarded after every put, even failed one
+    may have reached the IOC. Used by gateway too.
+    """
+
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+
+    # Reuse shared PV object with connected channel if possible
+    pv = borrowPV(ctx, pvurl)
+    try:
+        future = ctx["put_executor"].submit(pv.put, value, timeout)
+        yield tornado.gen.with_timeout(datetime.timedelta(seconds=timeout), future)
+        status = "success"
+    except tornado.gen.TimeoutError:
+        status = "error: timeout"
+    except Exception, e:
+        status = "error: {0}".format(str(e))
+    finally:
+        releasePV(pv)
+        ctx["get_cache"].discard(pvurl)
+
+    if status != "success":
+        log.warn("Failed to put {0}: {1}".format(pvurl, status))
+    raise tornado.gen.Return(status)
+
+class ValueCache():
+    """ Cache of recent channel get results, entries expire after ttl seconds. """
+
+    def __init__(self, ttl=1.0, size=1000):
+        self.ttl = ttl
+        self.size = size
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+        self._entries = ExpiringLRU(self.stats)
+
+    def get(self, pvurl):
+        """ Return cached PV structure or None when not cached or expired. """
+        value = self._entries.get(pvurl)
+        if value is not None:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+        return value
+
+    def put(self, pvurl, value):
+        if self.ttl <= 0 or self.size <= 0:
+            return
+        self._entries.put(pvurl, value, self.ttl, self.size)
+
+    def discard(self, pvurl):
+        """ Forget cached PV structure, ie. when new value was put. """
+        self._entries.pop(pvurl)
+
+@tornado.gen.coroutine
+def getValue(ctx, pvurl, fields, timeout):
+    """ Return current PV structure filtered to fields, raise exception on failure.
+
+    PV with active monitor receiving requested fields provides its cached
+    value right away. Otherwise channel get is done in executor thread.
+    Results are kept in cache for a short time and concurrent gets of the
+    same PV share single channel get.
+    """
+
+    pv = pvs.get(pvurl)
+    if pv is not None and pv.getCached() and pv.isMonitored(fields):
+        raise tornado.gen.Return(filterUpdate(pv.getCached(), fields))
+
+    value = ctx["get_cache"].get(pvurl)
+    if value is None:
+        future = ctx["get_pending"].get(pvurl)
+        if future is None:
+            future = _fetchValue(ctx, pvurl, timeout)
+            ctx["get_pending"][pvurl] = future
+            def done(future):
+                del ctx["get_pending"][pvurl]
+            future.add_done_callback(done)
+        value = yield future
+
+    raise tornado.gen.Return(filterUpdate(value, fields))
+
+@tornado.gen.coroutine
+def _fetchValue(ctx, pvurl, timeout):
+    """ Do channel get in executor thread and cache the result. """
+
+    pv = borrowPV(ctx, pvurl)
+    try:
+        future = ctx["get_executor"].submit(pv.get, timeout)
+        value = yield tornado.gen.with_timeout(datetime.timedelta(seconds=timeout), future)
+    except tornado.gen.TimeoutError:
+        raise WebEpicsWarning("timeout")
+    finally:
+        releasePV(pv)
+
+    ctx["get_cache"].put(pvurl, value)
+    raise tornado.gen.Return(value)
 
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
     def check_origin(self, origin):
@@ -173,18 +1035,87 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         """
         return True
 
+    @staticmethod
+    def createContext(cfg):
+        """ Create context to be used by all WebSocketHandler instancies. """
+        ctx = {}
+        ctx["queue_size"] = int(cfg.get("queue_size", 16))
+        ctx["multiplex"] = bool(cfg.get("multiplex", False))
+        ctx["binary"] = bool(cfg.get("binary", False))
+        ctx["binary_min_size"] = int(cfg.get("binary_min_size", 64))
+        ctx["max_buffer"] = int(cfg.get("max_buffer", 4*1024*1024))
+        ctx["stall_timeout"] = float(cfg.get("stall_timeout", 30.0))
+        ctx["buffer_check_interval"] = 0.5
+        ctx["put_timeout"] = float(cfg.get("put_timeout", 5.0))
+        ctx["put_executor"] = concurrent.futures.ThreadPoolExecutor(int(cfg.get("put_threads", 4)))
+        ctx["get_timeout"] = float(cfg.get("get_timeout", 5.0))
+        ctx["get_executor"] = concurrent.futures.ThreadPoolExecutor(int(cfg.get("get_threads", 4)))
+        ctx["get_cache"] = ValueCache(float(cfg.get("get_cache_ttl", 1.0)), int(cfg.get("get_cache_size", 1000)))
+        ctx["get_pending"] = {}
+        ctx["session_history"] = int(cfg.get("session_history", 32))
+        ctx["deadband_hold"] = float(cfg.get("deadband_hold", 1.0))
+
+        # Channel factory of selected backend or PV gateway, default is pvaccess
+        ctx["channel_factory"] = None
+
+        pool.linger = float(cfg.get("linger", 10.0))
+        pool.size = int(cfg.get("linger_pool_size", 1000))
+        sessions.grace = float(cfg.get("session_grace", 30.0))
+        sessions.size = int(cfg.get("session_pool_size", 10000))
+
+        return ctx
+
+    def initialize(self, ctx):
+        """ Called by Tornado before every request, the only place to pass in ctx. """
+        self._ctx = ctx
+
     def open(self):
         """ Overload open method. """
 
         # Map of pvurl, pvinfo pairs
         self._pvs = {}
 
-        self._lock = tornado.locks.Lock()
+        # Rate limited updates are coalesced in the IOLoop of this connection
+        self._ioloop = tornado.ioloop.IOLoop.current()
+
+        # In multiplex mode all updates generated in one IOLoop iteration
+        # are sent to client in a single pv_updates frame
+        self._multiplex = self.get_argument("multiplex", "1" if self._ctx["multiplex"] else "0") == "1"
+        self._outbox = []
+        self._outboxBytes = 0
+
+        # Bytes passed to the stream until they're flushed to the socket
+        self._pendingBytes = 0
+
+        # In binary mode numeric arrays are sent as binary typed arrays
+        self._binary = self.get_argument("binary", "1" if self._ctx["binary"] else "0") == "1"
+
+        # Slow client handling, see _writeUpdate()
+        self._degraded = None
+        self._dirty = set()
+
+        # Token of the session, see _reqSession()
+        self._session = None
+
+        clients.add(self)
 
     def on_close(self):
         """ Overload on_close method. """
-        for _, pvinfo in self._pvs.iteritems():
-            pvinfo["pv"].unsubscribe(self)
+        clients.discard(self)
+
+        if self._session is not None:
+            sessions.detach(self._session, self, self.getSubscriptions())
+            self._session = None
+
+        for pvinfo in self._pvs.itervalues():
+            self._cancelFlush(pvinfo)
+        unsubscribeAll(self, (pvinfo["pv"] for pvinfo in self._pvs.itervalues()))
+        self._pvs = {}
+
+        if self._degraded is not None:
+            self._ioloop.remove_timeout(self._degraded["timer"])
+            self._degraded = None
+            clientStats["degraded"] -= 1
 
     def on_message(self, message):
         try:
@@ -192,11 +1123,37 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         except:
             log.warn("Invalid request: failed to decode JSON request")
             return
+        if not isinstance(message, dict):
+            log.warn("Invalid request: not a JSON object")
+            return
 
         self.handleRequest(message)
 
     def handleRequest(self, message):
-        """ Parse, verify and process the request from client. """
+        """ Parse, verify and process the request from client.
+
+        pv_subscribe and pv_unsubscribe requests can specify a list of PVs
+        in 'pvs' field instead of a single 'pv', in which case request is
+        processed for each PV in the list. session request is the only one
+        not related to any PV.
+        """
+
+        if message.get("req") == "session":
+            try:
+                self._reqSession(message)
+            except Exception, e:
+                log.error("Request failed: {0}".format(str(e)))
+            return
+
+        if "pvs" in message and message.get("req") in ("pv_subscribe", "pv_unsubscribe"):
+            if not isinstance(message["pvs"], list):
+                log.warn("Invalid request: invalid 'pvs' field")
+                return
+            pvurls = message.pop("pvs")
+            for pvurl in pvurls:
+                message["pv"] = pvurl
+                self.handleRequest(dict(message))
+            return
 
         if "pv" not in message:
             log.warn("Invalid request: missing 'pv' field")
@@ -226,22 +1183,176 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         except Exception, e:
             log.error("Request failed: {0}".format(str(e)))
 
-    @tornado.gen.coroutine
-    def onPvUpdate(self, pvurl, update):
-        """ Send response to the client. """
+    def onPvUpdate(self, pvurl, update, encoded=None):
+        """ Send response to the client, called from IOLoop.
+
+        encoded is optional EncodedUpdate object of the update, shared by
+        all clients subscribed to the same PV. Rate limited subscriptions
+        need to merge updates and encode them on their own.
+        """
         if pvurl in self._pvs:
-            if self._pvs[pvurl]["one_time"]:
-                self._pvs[pvurl]["pv"].unsubscribe(self)
-                del self._pvs[pvurl]
+            if self._pvs[pvurl]["rate_limit"] > 0:
+                self._coalesceUpdate(pvurl, update, encoded.getSeq() if encoded is not None else None)
+                return
 
-            rsp = dict(update)
-            rsp["pv"] = pvurl
-            rsp["rsp"] = "pv_update"
+            self._writeUpdate(pvurl, update, encoded)
 
-            # Need to serialize writes to client, as monitor callback may
-            # be invoked form different threads
-            with (yield self._lock.acquire()):
-                self.write_message(rsp)
+    def write_message(self, message, binary=False):
+        """ Overloaded write_message to collect statistics of sent data. """
+        if isinstance(message, dict):
+            message = tornado.escape.json_encode(message)
+        future = super(WebSocketHandler, self).write_message(message, binary)
+        size = len(message)
+        clientStats["messages_sent"] += 1
+        clientStats["bytes_sent"] += size
+
+        # Future resolves when message is flushed to socket or connection closes
+        self._pendingBytes += size
+        def flushed(future):
+            self._pendingBytes -= size
+            future.exception()
+        future.add_done_callback(flushed)
+        return future
+
+    def getWriteBufferSize(self):
+        """ Return number of bytes queued for client but not yet sent, including multiplex outbox. """
+        return self._pendingBytes + self._outboxBytes
+
+    def _writeUpdate(self, pvurl, update, encoded=None, seq=None):
+        """ Turn PV update into pv_update response and send it to client.
+
+        When client can not keep up and its unsent data grows over max_buffer
+        bytes, client is degraded to latest-value-only mode. All updates are
+        dropped until the buffer drains, PVs that changed in the meantime are
+        then sent in full. Client stalled for longer than stall_timeout is
+        disconnected.
+        """
+        if self._degraded is not None:
+            self._dirty.add(pvurl)
+            return
+
+        if self.getWriteBufferSize() > self._ctx["max_buffer"]:
+            log.warn("Client {0} can't keep up, sending only latest values".format(self.getClientId()))
+            self._degraded = {
+                "since": self._ioloop.time(),
+                "timer": self._ioloop.call_later(self._ctx["buffer_check_interval"], self._checkDegraded)
+            }
+            clientStats["degraded"] += 1
+            self._dirty.add(pvurl)
+            return
+
+        if encoded is None:
+            encoded = EncodedUpdate(pvurl, update, seq)
+
+        if self._binary:
+            frame = encoded.getBinary(self._ctx["binary_min_size"])
+            if frame is not None:
+                # Binary frames can't be multiplexed, preserve the order
+                self._flushOutbox()
+                self.write_message(frame, binary=True)
+                return
+
+        frame = encoded.getJson()
+        if not self._multiplex:
+            self.write_message(frame)
+            return
+
+        if self.ws_connection is None:
+            raise tornado.websocket.WebSocketClosedError()
+        self._outbox.append(frame)
+        self._outboxBytes += len(frame)
+        if len(self._outbox) == 1:
+            self._ioloop.add_callback(self._flushOutbox)
+
+    def _flushOutbox(self):
+        """ Send all updates collected in this IOLoop iteration as single frame. """
+        frames, self._outbox = self._outbox, []
+        self._outboxBytes = 0
+        if len(frames) > 1:
+            # Frames are already encoded, no need to decode and encode again
+            frame = '{"rsp": "pv_updates", "updates": [' + ", ".join(frames) + ']}'
+        elif frames:
+            frame = frames[0]
+        else:
+            return
+
+        try:
+            self.write_message(frame)
+        except tornado.websocket.WebSocketClosedError:
+            # Subscriptions stay in _pvs for on_close() to detach session
+            unsubscribeAll(self, (pvinfo["pv"] for pvinfo in self._pvs.itervalues()))
+
+    def _checkDegraded(self):
+        """ Periodically check whether degraded client has recovered. """
+        if self.getWriteBufferSize() > self._ctx["max_buffer"] / 2:
+            if self._ioloop.time() - self._degraded["since"] > self._ctx["stall_timeout"]:
+                log.warn("Client {0} stalled, disconnecting".format(self.getClientId()))
+                clientStats["stalled_disconnects"] += 1
+                self.close()
+            else:
+                self._degraded["timer"] = self._ioloop.call_later(self._ctx["buffer_check_interval"], self._checkDegraded)
+            return
+
+        log.info("Client {0} recovered, sending {1} PVs".format(self.getClientId(), len(self._dirty)))
+        self._degraded = None
+        clientStats["degraded"] -= 1
+
+        dirty, self._dirty = self._dirty, set()
+        for pvurl in dirty:
+            pvinfo = self._pvs.get(pvurl)
+            if pvinfo is not None and pvinfo["pv"].getCached():
+                pv = pvinfo["pv"]
+                try:
+                    self._writeUpdate(pvurl, filterUpdate(pv.getCached(), pvinfo["fields"]), seq=pv.getSeq())
+                except tornado.websocket.WebSocketClosedError:
+                    break
+
+    def _coalesceUpdate(self, pvurl, update, seq=None):
+        """ Merge update into pending update and schedule sending it.
+
+        Sending is delayed so that client receives at most rate_limit updates
+        per second. All updates received in between are merged into single
+        update where latest values win, and latest sequence number.
+        """
+        pvinfo = self._pvs.get(pvurl)
+        if pvinfo is None:
+            return
+
+        if pvinfo["pending"] is None:
+            pvinfo["pending"] = {}
+        mergeUpdate(pvinfo["pending"], update)
+        pvinfo["seq"] = seq
+
+        if pvinfo["rate_limit"] <= 0:
+            # Rate limit was removed in the meantime, send right away
+            if pvinfo["flush"] is not None:
+                self._ioloop.remove_timeout(pvinfo["flush"])
+            self._flushUpdate(pvurl)
+        elif pvinfo["flush"] is None:
+            deadline = pvinfo["last_sent"] + 1.0 / pvinfo["rate_limit"]
+            pvinfo["flush"] = self._ioloop.call_at(deadline, self._flushUpdate, pvurl)
+
+    def _flushUpdate(self, pvurl):
+        """ Send pending coalesced update to client. """
+        pvinfo = self._pvs.get(pvurl)
+        if pvinfo is None:
+            return
+
+        pvinfo["flush"] = None
+        update, pvinfo["pending"] = pvinfo["pending"], None
+        if update:
+            pvinfo["last_sent"] = self._ioloop.time()
+            try:
+                self._writeUpdate(pvurl, update, seq=pvinfo["seq"])
+            except tornado.websocket.WebSocketClosedError:
+                pass
+
+    def _cancelFlush(self, pvinfo):
+        """ Cancel scheduled sending of coalesced update, if any. """
+        if pvinfo["flush"] is not None:
+            self._ioloop.remove_timeout(pvinfo["flush"])
+            pvinfo["flush"] = None
+        pvinfo["pending"] = None
 
     def getClientId(self):
         """ Return non-unique client ID useful for log. """
@@ -249,58 +1360,206 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         remote_ip = x_real_ip or self.request.remote_ip
         return remote_ip
 
-    def _reqSubscribe(self, message, one_time=False):
-        """ Handles subscribe message. """
+    def getSubscriptions(self):
+        """ Return parameters of all subscriptions by PV url, used to resume session. """
+        subscriptions = {}
+        for pvurl, pvinfo in self._pvs.iteritems():
+            subscriptions[pvurl] = {
+                "rate_limit": pvinfo["rate_limit"],
+                "fields": pvinfo["fields"],
+                "deadband": pvinfo["deadband"]
+            }
+        return subscriptions
+
+    def _getFields(self, message):
+        """ Return parsed optional 'fields' field of the request. """
+        fields = message.get("fields")
+        if not isinstance(fields, list):
+            if fields is not None:
+                log.warn("Invalid request: invalid 'fields' field")
+            fields = None
+        return parseFields(fields)
+
+    def _reqSubscribe(self, message):
+        """ Handles subscribe message.
+
+        Optional rate_limit field specifies maximum number of updates per
+        second client wants to receive for this PV, 0 means unlimited.
+        Optional fields field is a list of PV fields client wants to receive,
+        ie. [ "value", "alarm", "display.units" ], default is all fields.
+        Optional deadband field is absolute or relative value deadband, ie.
+        0.01 or "0.1%", see parseDeadband().
+        """
+
+        try:
+            rate_limit = max(0.0, float(message.get("rate_limit", 0)))
+        except (TypeError, ValueError):
+            log.warn("Invalid request: invalid 'rate_limit' field")
+            rate_limit = 0.0
+
+        fields = self._getFields(message)
+
+        deadband = parseDeadband(message.get("deadband"))
+        if deadband is None and message.get("deadband") is not None:
+            log.warn("Invalid request: invalid 'deadband' field")
+
+        self._subscribe(message["pv"], rate_limit, fields, deadband)
 
-        if message["pv"] in self._pvs:
-            if not one_time:
-                self._pvs[ message["pv"] ]["one_time"] = False
+    def _subscribe(self, pvurl, rate_limit, fields, deadband, seq=None):
+        """ Subscribe to PV or change parameters of existing subscription.
+
+        seq is sequence number of the last update client already received,
+        see PV.subscribe().
+        """
+        if pvurl in self._pvs:
+            pvinfo = self._pvs[pvurl]
+            pvinfo["rate_limit"] = rate_limit
+            if rate_limit == 0 and pvinfo["flush"] is not None:
+                # Don't let pending update overtake future updates
+                self._ioloop.remove_timeout(pvinfo["flush"])
+                self._flushUpdate(pvurl)
+            if fields != pvinfo["fields"] or deadband != pvinfo["deadband"]:
+                pvinfo["fields"] = fields
+                pvinfo["deadband"] = deadband
+                pvinfo["pv"].subscribe(self, fields, deadband)
         else:
             # Create a PV object
-            if message["pv"] in pvs:
-                pv = pvs[ message["pv"] ]
+            if pvurl in pvs:
+                pv = pvs[pvurl]
             else:
-                pv = PV(str(message["pv"]))
-                pvs[ message["pv"] ] = pv
+                pv = createPV(self._ctx, pvurl)
+                pvs[pvurl] = pv
 
-            self._pvs[ message["pv"] ] = {
+            self._pvs[pvurl] = {
                 "pv": pv,
-                "one_time": one_time,
-                "rate_limit": 0
+                "rate_limit": rate_limit,
+                "fields": fields,
+                "deadband": deadband,
+                "pending": None,
+                "seq": None,
+                "last_sent": 0,
+                "flush": None
             }
 
             # Subscribe to updates
-            pv.subscribe(self)
+            pv.subscribe(self, fields, deadband, seq)
 
     def _reqUnsubscribe(self, message):
         """ Handles pv_subscribe message. """
         pvinfo = self._pvs.pop(message["pv"], None)
         if pvinfo is not None:
+            self._cancelFlush(pvinfo)
             pvinfo["pv"].unsubscribe(self)
 
+    def _reqSession(self, message):
+        """ Handles session message.
+
+        Request without 'session' field starts a new session. Client that
+        reconnected passes token of its previous session in 'session' field
+        and 'acks' field, a dictionary of PV urls and sequence numbers of
+        the last update received for each PV. When the session is still
+        known, its subscriptions are restored and client only receives
+        fields changed since acknowledged updates. Otherwise a new session
+        is started and client needs to subscribe again. Client receives
+        session response with 'session' token and 'resumed' flag.
+        """
+        if self._session is not None:
+            log.warn("Invalid request: session already started")
+            return
+
+        subscriptions = None
+        token = message.get("session")
+        if isinstance(token, basestring):
+            subscriptions = sessions.resume(token, self)
+        if subscriptions is None:
+            token = sessions.create(self)
+        self._session = token
+
+        self.write_message({ "rsp": "session", "session": token, "resumed": subscriptions is not None })
+        if not subscriptions:
+            return
+
+        acks = message.get("acks")
+        if not isinstance(acks, dict):
+            acks = {}
+        for pvurl, params in subscriptions.iteritems():
+            seq = acks.get(pvurl)
+            if not isinstance(seq, (int, long)):
+                seq = None
+            self._subscribe(pvurl, params["rate_limit"], params["fields"], params["deadband"], seq)
+        log.info("Client {0} resumed session with {1} PVs".format(self.getClientId(), len(subscriptions)))
+
+    @tornado.gen.coroutine
     def _reqGet(self, message):
-        """ Handles pv_get message. """
+        """ Handles pv_get message.
 
-        if message["pv"] not in self._pvs:
-            self._reqSubscribe(message, one_time=True)
+        Client receives pv_update response with current PV value, limited
+        to optional 'fields' list. When get fails or times out, pv_get
+        response with error status is sent instead. Optional 'timeout' field
+        overrides default get timeout in seconds.
+        """
 
+        fields = self._getFields(message)
+        try:
+            timeout = float(message.get("timeout", self._ctx["get_timeout"]))
+        except (TypeError, ValueError):
+            timeout = self._ctx["get_timeout"]
+
+        try:
+            update = yield getValue(self._ctx, message["pv"], fields, timeout)
+        except Exception, e:
+            log.warn("Failed to get {0}: {1}".format(message["pv"], str(e)))
+            rsp = {
+                "pv": message["pv"],
+                "rsp": "pv_get",
+                "status": "error: {0}".format(str(e))
+            }
+            try:
+                self.write_message(rsp)
+            except tornado.websocket.WebSocketClosedError:
+                pass
+            return
+
+        if not update:
+            return
+        try:
+            if self.ws_connection is None:
+                raise tornado.websocket.WebSocketClosedError()
+            self._writeUpdate(message["pv"], update)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    @tornado.gen.coroutine
     def _reqPut(self, message):
-        """ Handles pv_set message. """
+        """ Handles pv_put message.
+
+        Put is executed in a thread pool not to block IOLoop. Client receives
+        pv_put response with status and latency in milliseconds once put
+        completes, fails or times out. Optional 'timeout' field overrides
+        default put timeout in seconds, optional 'id' field is copied to
+        response.
+        """
 
         rsp = {
             "pv": message["pv"] if "pv" in message else "undefined",
             "rsp": "pv_put"
         }
+        if "id" in message:
+            rsp["id"] = message["id"]
 
-        print message
+        start = time.time()
         if "pv" not in message or "value" not in message:
             rsp["status"] = "error: invalid request"
         else:
-            # TODO: this needs to be asynchronized
-            pv = PV(str(message["pv"]))
-            pv.put(1)
-            rsp["status"] = "success"
+            try:
+                timeout = float(message.get("timeout", self._ctx["put_timeout"]))
+            except (TypeError, ValueError):
+                timeout = self._ctx["put_timeout"]
 
-        print rsp
+            rsp["status"] = yield putValue(self._ctx, message["pv"], message["value"], timeout)
+        rsp["latency"] = round((time.time() - start) * 1000, 3)
 
-        #self.write_message(rsp)
+        try:
+            self.write_message(rsp)
+        except tornado.websocket.WebSocketClosedError:
+            pass